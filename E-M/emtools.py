@@ -0,0 +1,141 @@
+import os
+import math
+
+import numpy as np
+import pandas as pd
+from uncertainties import ufloat
+
+
+# ---------------------------- Apparatus constants ---------------------------
+
+A = 0.33  # Coil radius, units in meters
+N = 72  # Turns per coil
+MU = 4*math.pi*math.pow(10, -7)  # exact number. This is for free space
+RADII = np.array([0.065, 0.078, 0.090, 0.103, 0.115])/2  # Pin radii, also in meters
+ACCEPTED_VALUE = 1.76*math.pow(10, 11)  # coulombs/kg
+
+COLUMNS = ["s", "V", "A", "mT"]
+PINS = range(1, len(RADII) + 1)
+FILES = (['InitialCurrent.txt'] + ['OuterPin{}.txt'.format(i) for i in PINS]
+         + ['InnerPin{}.txt'.format(i) for i in PINS])
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "EM_data")
+
+
+# ------------------------------- Loading data --------------------------------
+# Every folder holds an InitialCurrent reading plus an Outer and Inner
+# reading per pin. They're all stacked into one NaN-padded array of shape
+# (folders, files, samples, columns), so the rest is plain broadcasting.
+
+def read_run(path):
+    data = pd.read_csv(path, sep="\t")
+    data.columns = COLUMNS
+    return data.values.astype(float)
+
+def load_runs(data_dir=DATA_DIR):
+    # Returns the folder names, the stacked readings and the number of
+    # samples in each file, shaped (folders, files).
+    folders = sorted(folder for folder in os.listdir(data_dir)
+                     if os.path.isdir(os.path.join(data_dir, folder)))
+    runs = [[read_run(os.path.join(data_dir, folder, name)) for name in FILES]
+            for folder in folders]
+
+    lengths = np.array([[len(run) for run in folder_runs] for folder_runs in runs])
+    stacked = np.full((len(folders), len(FILES), lengths.max(initial=0), len(COLUMNS)), np.nan)
+    for i, folder_runs in enumerate(runs):
+        for j, run in enumerate(folder_runs):
+            stacked[i, j, :len(run)] = run
+    return folders, stacked, lengths
+
+def align_pins(stacked, lengths):
+    # Average each Inner/Outer pair element-wise and take the static current
+    # of the InitialCurrent reading off the averaged current. Every pin is
+    # cut to the shortest of its three files in one masking step. Returns
+    # (folders, pins, samples, columns) with NaN past each pin's length.
+    offset, outer, inner = stacked[:, :1], stacked[:, 1:len(RADII) + 1], stacked[:, len(RADII) + 1:]
+    pins = (outer + inner)/2
+    pins[..., COLUMNS.index("A")] -= offset[..., COLUMNS.index("A")]
+
+    min_len = np.minimum(np.minimum(lengths[:, 1:len(RADII) + 1], lengths[:, len(RADII) + 1:]),
+                         lengths[:, :1])
+    pins[np.arange(pins.shape[2]) >= min_len[..., None]] = np.nan
+    return pins, min_len
+
+
+# ------------------------------- e/m quantities ------------------------------
+
+def mag_field(I):
+    # B-field at the center of our Helmholtz coils.
+    return (8*N*MU*I)/(math.sqrt(125)*A)
+
+def em_quantities(pins):
+    # V, I, B, B^2 and 2V/r^2 for every folder, pin and sample at once.
+    V = pins[..., COLUMNS.index("V")]
+    I = pins[..., COLUMNS.index("A")]
+    B = mag_field(I)
+    r = np.where(np.isnan(V), np.nan, RADII[None, :, None])
+    return {'V': V, 'I': I, 'B': B, 'B2': B**2, 'r': r, 'y': (2*V)/(r**2)}
+
+def flatten(values):
+    # The valid samples in folder, pin, sample order, like the notebook's
+    # flattened lists.
+    return values[~np.isnan(values)]
+
+def load_em(data_dir=DATA_DIR):
+    folders, stacked, lengths = load_runs(data_dir)
+    pins, min_len = align_pins(stacked, lengths)
+    return folders, em_quantities(pins)
+
+
+# ------------------------------- Fitting e/m ---------------------------------
+# 2V/r^2 = (e/m) B^2, with errors on both axes. Errors are propagated
+# analytically as arrays and the line is fit with York's weighted
+# errors-in-variables regression, so both x and y errors count.
+
+def em_errors(q, r_err=0.001):
+    # Per-pin errors as in the notebook: half the spread of B and V over a
+    # pin's samples, and r_err on the radius. Returns (x_err, y_err) for
+    # x = B^2 and y = 2V/r^2, shaped like q['B2'].
+    B_err = (np.nanmax(q['B'], axis=-1, keepdims=True) - np.nanmin(q['B'], axis=-1, keepdims=True))/2
+    V_err = (np.nanmax(q['V'], axis=-1, keepdims=True) - np.nanmin(q['V'], axis=-1, keepdims=True))/2
+    x_err = 2*np.abs(q['B'])*B_err
+    y_err = np.abs(q['y'])*np.sqrt((V_err/q['V'])**2 + (2*r_err/q['r'])**2)
+    return x_err, y_err
+
+def york_fit(x, y, x_err, y_err, tol=1e-15, max_iter=100):
+    # Straight line y = slope*x + intercept through points with errors on
+    # both axes (York et al., Am. J. Phys. 72, 367 (2004)). Returns the
+    # slope and intercept as ufloats and the reduced chi^2.
+    x, y = np.asarray(x, dtype=float), np.asarray(y, dtype=float)
+    # Points without a spread (one sample, say) would get infinite weight.
+    floor = lambda err, values: np.maximum(err, np.finfo(float).eps*np.abs(values).max())
+    w_x, w_y = 1/floor(np.asarray(x_err), x)**2, 1/floor(np.asarray(y_err), y)**2
+
+    slope = np.polyfit(x, y, 1)[0]
+    for _ in range(max_iter):
+        W = w_x*w_y/(w_x + slope**2*w_y)
+        x_bar, y_bar = W.dot(x)/W.sum(), W.dot(y)/W.sum()
+        U, V = x - x_bar, y - y_bar
+        beta = W*(U/w_y + slope*V/w_x)
+        new_slope = (W*beta).dot(V)/(W*beta).dot(U)
+        done = abs(new_slope - slope) <= tol*abs(new_slope)
+        slope = new_slope
+        if done:
+            break
+
+    W = w_x*w_y/(w_x + slope**2*w_y)
+    x_bar, y_bar = W.dot(x)/W.sum(), W.dot(y)/W.sum()
+    intercept = y_bar - slope*x_bar
+    beta = W*((x - x_bar)/w_y + slope*(y - y_bar)/w_x)
+    adjusted = x_bar + beta
+    u = adjusted - W.dot(adjusted)/W.sum()
+    slope_err = math.sqrt(1/W.dot(u**2))
+    intercept_err = math.sqrt(1/W.sum() + (W.dot(adjusted)/W.sum())**2*slope_err**2)
+    chi2 = W.dot((y - slope*x - intercept)**2)/max(1, len(x) - 2)
+    return ufloat(slope, slope_err), ufloat(intercept, intercept_err), chi2
+
+def fit_em(q, r_err=0.001):
+    # e/m (and the intercept) from every valid sample of load_em's output.
+    x_err, y_err = em_errors(q, r_err)
+    valid = ~np.isnan(q['B2'])
+    return york_fit(q['B2'][valid], q['y'][valid], x_err[valid], y_err[valid])
@@ -0,0 +1,175 @@
+# Benchmarks for the miltools hot paths on synthetic workloads.
+#
+#   python bench_miltools.py                  # full sweep, saved under results/
+#   python bench_miltools.py --quick          # smallest sizes only
+#   python bench_miltools.py --compare results/old.json
+#
+# Each case reports the best wall time over --repeat runs, and the peak
+# traced allocation of one extra run.
+
+import os
+import sys
+import json
+import time
+import argparse
+import contextlib
+import platform
+import tempfile
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import miltools
+from uncertainties import ufloat
+
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'results')
+PX_PER_MM = ufloat(37, 2)*10
+FPS = 30
+
+
+# ---------------------------- Synthetic workloads ----------------------------
+
+def random_track(n, particle=0, seed=0):
+    # A drop falling at ~0.6 px/frame with 2 px of position noise.
+    rng = np.random.default_rng(seed)
+    frames = np.arange(n)
+    return pd.DataFrame({'y': 0.6*frames + rng.normal(0, 2, n),
+                         'x': 100 + rng.normal(0, 2, n),
+                         'mass': rng.uniform(700, 8000, n),
+                         'particle': particle},
+                        index=pd.Index(frames, name='frame'))
+
+# Files a case's setup creates, removed once the case has been measured.
+cleanup = contextlib.ExitStack()
+
+def up_down_track(n, seed=0):
+    # Alternating fall (+0.6 px/frame) and rise (-0.4 px/frame) phases of
+    # 150-450 frames with 2 px of noise, like a drop under a switched field.
+    rng = np.random.default_rng(seed)
+    lengths = rng.integers(150, 450, n//150 + 1)
+    speeds = np.resize([0.6, -0.4], len(lengths))
+    y = np.cumsum(np.repeat(speeds, lengths)[:n]) + rng.normal(0, 2, n)
+    x = 100 + np.cumsum(rng.normal(0, 0.3, n)) + rng.normal(0, 2, n)
+    return np.column_stack([x, y])
+
+def track_directory(n_particles, n_frames=300):
+    path = cleanup.enter_context(tempfile.TemporaryDirectory(prefix='miltools-bench-'))
+    tracks = [random_track(n_frames, p, seed=p).reset_index() for p in range(n_particles)]
+    pd.concat(tracks).sort_values('frame', kind='stable').to_csv(
+        os.path.join(path, 'track0.csv'), sep='\t', index=False)
+    return os.path.join(path, 'track*.csv')
+
+def segment_pairs(n_segments, length=150):
+    fall = [random_track(length, seed=i) for i in range(n_segments)]
+    rise = [track.assign(y=-track.y) for track in fall]
+    return fall, rise
+
+
+# --------------------------------- Cases -------------------------------------
+# name -> (sizes, quick sizes, setup(size) -> zero-argument callable)
+
+def setup_rdp(n):
+    points = up_down_track(n)
+    return lambda: miltools.rdp_indices(points, 16.5)
+
+def setup_calc_velocity(n):
+    track = random_track(n)
+    return lambda: miltools.calc_velocity(track, PX_PER_MM, FPS)
+
+def setup_calc_charge(n):
+    rng = np.random.default_rng(0)
+    v_f, v_r = rng.uniform(2e-5, 1e-4, n), rng.uniform(2e-5, 1e-4, n)
+    return lambda: [miltools.calc_charge(ufloat(f, f/20), ufloat(r, r/20))
+                    for f, r in zip(v_f, v_r)]
+
+def setup_calc_charges(n):
+    rng = np.random.default_rng(0)
+    v_f, v_r = rng.uniform(2e-5, 1e-4, n), rng.uniform(2e-5, 1e-4, n)
+    return lambda: miltools.calc_charges(v_f, v_r, v_f/20, v_r/20)
+
+def setup_analyze_df(n):
+    fall, rise = segment_pairs(n)
+    return lambda: [miltools.analyze_df(f, r, PX_PER_MM, FPS) for f, r in zip(fall, rise)]
+
+def setup_analyze_pairs(n):
+    pairs = list(zip(*segment_pairs(n)))
+    return lambda: miltools.analyze_pairs(pairs, PX_PER_MM, FPS)
+
+def setup_load_tracks(n):
+    addr = track_directory(n)
+    return lambda: miltools.load_tracks(addr)
+
+CASES = {'rdp': ([10**2, 10**3, 10**4, 10**5, 10**6], [10**2, 10**3], setup_rdp),
+         'calc_velocity': ([10**2, 10**3, 10**4, 10**5, 10**6], [10**2, 10**3], setup_calc_velocity),
+         'calc_charge': ([10, 10**2, 10**3, 10**4, 10**5], [10, 10**2], setup_calc_charge),
+         'calc_charges': ([10, 10**2, 10**3, 10**4, 10**5], [10, 10**2], setup_calc_charges),
+         'analyze_df': ([10, 10**2, 10**3, 10**4, 10**5], [10, 10**2], setup_analyze_df),
+         'analyze_pairs': ([10, 10**2, 10**3, 10**4, 10**5], [10, 10**2], setup_analyze_pairs),
+         'load_tracks': ([10, 10**2, 10**3], [10], setup_load_tracks)}
+
+
+# --------------------------------- Driver ------------------------------------
+
+def measure(func, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    func()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return min(times), peak
+
+def run(names, quick, repeat):
+    results = []
+    for name in names:
+        sizes, quick_sizes, setup = CASES[name]
+        for size in (quick_sizes if quick else sizes):
+            with cleanup:
+                seconds, peak = measure(setup(size), repeat)
+            results.append({'case': name, 'size': size, 'seconds': seconds, 'peak_bytes': peak})
+            print("{:<14} {:>8} {:>12.6f} s {:>10.1f} MiB".format(name, size, seconds, peak/2**20))
+    return results
+
+def compare(results, old_file):
+    with open(old_file) as f:
+        old = {(r['case'], r['size']): r for r in json.load(f)['results']}
+    print("\n{:<14} {:>8} {:>10} {:>10}".format('case', 'size', 'time x', 'memory x'))
+    for r in results:
+        before = old.get((r['case'], r['size']))
+        if before:
+            print("{:<14} {:>8} {:>10.2f} {:>10.2f}".format(
+                r['case'], r['size'], r['seconds']/before['seconds'],
+                r['peak_bytes']/max(1, before['peak_bytes'])))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the miltools hot paths.")
+    parser.add_argument('cases', nargs='*', default=list(CASES),
+                        help="any of: " + ", ".join(CASES))
+    parser.add_argument('--quick', action='store_true', help="only the smallest sizes")
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--label', default=time.strftime('%Y%m%d-%H%M%S'))
+    parser.add_argument('--compare', help="earlier results file to compare against")
+    args = parser.parse_args(argv)
+    for name in args.cases:
+        if name not in CASES:
+            parser.error("unknown case " + name)
+
+    results = run(args.cases, args.quick, args.repeat)
+    os.makedirs(RESULTS_DIR, exist_ok=True)
+    out = os.path.join(RESULTS_DIR, args.label + '.json')
+    with open(out, 'w') as f:
+        json.dump({'label': args.label, 'python': platform.python_version(),
+                   'machine': platform.machine(), 'results': results}, f, indent=1)
+    print("Saved", out)
+
+    if args.compare:
+        compare(results, args.compare)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,98 @@
+import os
+import math
+
+import numpy as np
+import pandas as pd
+
+from miltools import B, G, ETA, PRESSURE, PLATE_DIFF, PLATE_SPACING, RHO
+
+
+# --------------------------- Synthetic Millikan drops ---------------------------
+# Drops are simulated with the same model miltools inverts: a drop of
+# radius a falls at v_f = 2 g rho (a^2 + 2 a b/2p) / (9 eta) with the field
+# off, and rises at v_r = q E v_f / (m g) - v_f with it on. Brownian
+# jitter and detector noise are added on top, and the tracks are written
+# in the tab-separated layout load_tracks reads.
+
+ELEMENTARY_CHARGE = 1.602176634e-19  # Coulombs
+BOLTZMANN = 1.380649e-23  # J/K
+
+# (direction, seconds) phases of the plate voltage: 'down' with the field
+# off, 'up' with it on.
+DEFAULT_SCHEDULE = [('down', 10), ('up', 5)]*4
+
+
+def drop_velocities(radius, charge):
+    b_over_2p = B/(2*PRESSURE[0])
+    v_f = 2*G*RHO[0]*(radius**2 + 2*radius*b_over_2p)/(9*ETA[0])
+    m = 4*math.pi*(radius**3)*RHO[0]/3
+    E = PLATE_DIFF[0]/PLATE_SPACING[0]
+    v_r = charge*E*v_f/(m*G) - v_f
+    return v_f, v_r
+
+def simulate_run(n_drops, schedule=DEFAULT_SCHEDULE, radius=(0.4e-6, 0.9e-6),
+                 multiples=(1, 5), fps=30, px_per_mm=370, px_noise=2,
+                 temperature=296.15, seed=None):
+    # Returns (tracks, drops, phases): trackpy-style rows for every drop,
+    # the true radius/charge/velocities per drop, and the (direction, first
+    # frame, last frame) of every phase of the schedule.
+    rng = np.random.default_rng(seed)
+    radius = rng.uniform(*radius, n_drops) if np.ndim(radius) else np.full(n_drops, radius)
+    multiple = rng.integers(multiples[0], multiples[1] + 1, n_drops)
+    v_f, v_r = drop_velocities(radius, multiple*ELEMENTARY_CHARGE)
+
+    lengths = [int(round(seconds*fps)) for _, seconds in schedule]
+    is_up = np.repeat([direction == 'up' for direction, _ in schedule], lengths)
+    n_frames = len(is_up)
+
+    # Per-frame displacement in px (image y grows downwards), with Stokes-
+    # Einstein diffusion for the Brownian part.
+    px_per_m = px_per_mm*1000
+    step = np.where(is_up[None, :], -v_r[:, None], v_f[:, None])/fps*px_per_m
+    diffusion = BOLTZMANN*temperature/(6*math.pi*ETA[0]*radius)
+    jitter = np.sqrt(2*diffusion/fps)[:, None]*px_per_m
+    y = np.cumsum(step + jitter*rng.standard_normal((n_drops, n_frames)), axis=1)
+    x = np.cumsum(jitter*rng.standard_normal((n_drops, n_frames)), axis=1)
+    y += rng.uniform(100, 300, (n_drops, 1)) + px_noise*rng.standard_normal((n_drops, n_frames))
+    x += rng.uniform(100, 500, (n_drops, 1)) + px_noise*rng.standard_normal((n_drops, n_frames))
+
+    # Frame-major row order, like trackpy's output.
+    tracks = pd.DataFrame({'frame': np.tile(np.arange(n_frames), n_drops),
+                           'x': x.ravel(), 'y': y.ravel(),
+                           'mass': rng.uniform(700, 8000, n_drops*n_frames),
+                           'particle': np.repeat(np.arange(n_drops), n_frames)})
+    tracks = tracks.sort_values(['frame', 'particle'], kind='stable', ignore_index=True)
+
+    drops = pd.DataFrame({'particle': np.arange(n_drops), 'radius': radius,
+                          'multiple': multiple, 'charge': multiple*ELEMENTARY_CHARGE,
+                          'v_fall': v_f, 'v_rise': v_r})
+    bounds = np.cumsum([0] + lengths)
+    phases = [(direction, start, stop - 1)
+              for (direction, _), start, stop in zip(schedule, bounds[:-1], bounds[1:])]
+    return tracks, drops, phases
+
+def write_campaign(out_dir, n_runs, drops_per_run, seed=None, fps=30, **kwargs):
+    # Writes <out_dir>/sim<i>/track0.csv for every run, plus the ground
+    # truth: segments.csv in the manifest format load_all_trajectories
+    # takes, and charges.csv with every drop's radius and charge.
+    rng = np.random.default_rng(seed)
+    segments, charges = [], []
+    for run in range(n_runs):
+        directory = 'sim{}'.format(run)
+        tracks, drops, phases = simulate_run(drops_per_run, fps=fps, seed=rng, **kwargs)
+        os.makedirs(os.path.join(out_dir, directory), exist_ok=True)
+        tracks.to_csv(os.path.join(out_dir, directory, 'track0.csv'), sep='\t', index=False,
+                      float_format='%.4f')
+
+        charges.append(drops.assign(directory=directory))
+        for particle in drops.particle:
+            counts = {'up': 0, 'down': 0}
+            for direction, first, last in phases:
+                key = '{}_{}_{}_{}'.format(directory, particle, direction, counts[direction])
+                segments.append((key, directory, particle, first/fps, last/fps))
+                counts[direction] += 1
+
+    pd.DataFrame(segments, columns=['key', 'directory', 'particle', 'start', 'end']).to_csv(
+        os.path.join(out_dir, 'segments.csv'), index=False)
+    pd.concat(charges, ignore_index=True).to_csv(os.path.join(out_dir, 'charges.csv'), index=False)
+    return out_dir
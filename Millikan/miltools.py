@@ -2,12 +2,213 @@ from math import sqrt
 import math
 
 import os
+import csv
 import glob
+import fnmatch
+import json
+import time
+import logging
+import threading
+import functools
+import contextlib
+import tracemalloc
+from collections.abc import Mapping, Sequence
+from concurrent.futures import Future, ThreadPoolExecutor, ProcessPoolExecutor
+import numpy as np
 import pandas as pd
 from uncertainties import ufloat, unumpy
 from uncertainties.umath import *
 
 
+# ---------------------------- Apparatus constants ---------------------------
+# Uncertain quantities are (value, error) pairs, already in SI units.
+
+B = 0.0082  # Pascal Meters
+G = 9.80665  # meters per second squared
+ETA = (0.0000184, 0.0000004)  # viscosity of air in Ns/m^2.
+# This comes from Appendix A, using a temp. of 23C.
+
+PRESSURE = (1025.26*100, 0.1*100)  # Measured in hectopascals, converted to pascals.
+PLATE_DIFF = (498, 2)  # Measured, units in volts
+PLATE_SPACING = (0.30*2.54/100, 0.001*2.54/100)  # Caliper is in inches, so convert to meters.
+RHO = (863.4, 10.2)
+
+# Hand-picked up/down windows for every recorded particle.
+SEGMENTS_MANIFEST = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'segments.csv')
+
+
+# ------------------------------ Instrumentation ------------------------------
+# Entry points are wrapped with @instrumented. Outside of a Profile block
+# the wrapper is a single global check. Inside one, every stage records its
+# calls, wall time, rows processed and (optionally) peak traced
+# allocations, and event() calls are kept as structured records. Work sent
+# to process pools through submit() is profiled in the workers and merged
+# back.
+
+logger = logging.getLogger('miltools')
+_profile = None
+
+class Profile:
+    def __init__(self, report : str = None, allocations : bool = False):
+        # report: optional .json (stages and events) or .csv (stages) path
+        # written on exit.
+        self.report_path = report
+        self.allocations = allocations
+        self.stages = {}
+        self.events = []
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def __enter__(self):
+        global _profile
+        self._previous, _profile = _profile, self
+        self._start = time.perf_counter()
+        if self.allocations:
+            tracemalloc.start()
+        return self
+
+    def __exit__(self, *exc):
+        global _profile
+        _profile = self._previous
+        if self.allocations:
+            tracemalloc.stop()
+        if self.report_path:
+            self.write(self.report_path)
+
+    def _stack(self):
+        if not hasattr(self._local, 'stack'):
+            self._local.stack = []
+        return self._local.stack
+
+    def enter(self):
+        # Each open stage keeps [traced bytes at entry, highest peak seen
+        # while it was open], so nested stages can reset tracemalloc's peak
+        # without losing their parent's.
+        stack = self._stack()
+        if self.allocations:
+            current, peak = tracemalloc.get_traced_memory()
+            if stack:
+                stack[-1][1] = max(stack[-1][1], peak)
+            tracemalloc.reset_peak()
+            stack.append([current, current])
+        return time.perf_counter()
+
+    def exit(self, stage, start, rows):
+        seconds = time.perf_counter() - start
+        alloc = 0
+        if self.allocations:
+            stack = self._stack()
+            entry_bytes, peak = stack.pop()
+            peak = max(peak, tracemalloc.get_traced_memory()[1])
+            alloc = peak - entry_bytes
+            if stack:
+                stack[-1][1] = max(stack[-1][1], peak)
+
+        self._add(stage, {'calls': 1, 'seconds': seconds, 'rows': rows,
+                          'peak_alloc_bytes': alloc})
+
+    def _add(self, stage, other):
+        with self._lock:
+            stats = self.stages.setdefault(stage, {'calls': 0, 'seconds': 0.0,
+                                                   'rows': 0, 'peak_alloc_bytes': 0})
+            for key in ('calls', 'seconds', 'rows'):
+                stats[key] += other[key]
+            stats['peak_alloc_bytes'] = max(stats['peak_alloc_bytes'], other['peak_alloc_bytes'])
+
+    def merge(self, stages, events=()):
+        # Stages and events recorded in another process (see submit). Worker
+        # seconds add up across processes, so they can exceed wall time.
+        for stage, stats in stages.items():
+            self._add(stage, stats)
+        with self._lock:
+            self.events.extend(events)
+
+    def event(self, name, fields):
+        with self._lock:
+            self.events.append(dict(fields, event=name, time=time.perf_counter() - self._start))
+
+    def table(self) -> pd.DataFrame:
+        return pd.DataFrame.from_dict(self.stages, orient='index').rename_axis('stage')
+
+    def write(self, path : str):
+        if path.endswith('.csv'):
+            self.table().to_csv(path)
+        else:
+            with open(path, 'w') as f:
+                json.dump({'stages': self.stages, 'events': self.events}, f, indent=1, default=str)
+
+def default_rows(args, result):
+    # Rows processed: the length of the first argument, when it has one.
+    try:
+        return len(args[0])
+    except (IndexError, TypeError):
+        return 0
+
+def instrumented(stage : str = None, rows=default_rows):
+    def wrap(func):
+        name = stage or func.__name__
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            profile = _profile
+            if profile is None:
+                return func(*args, **kwargs)
+            start = profile.enter()
+            try:
+                result = func(*args, **kwargs)
+            except BaseException:
+                # Still close the stage, or the allocation stack stays off.
+                profile.exit(name, start, 0)
+                raise
+            profile.exit(name, start, rows(args, result))
+            return result
+        return wrapper
+    return wrap
+
+@contextlib.contextmanager
+def stage(name : str, rows : int = 0):
+    # For timing ad-hoc blocks (plotting, say) alongside the entry points.
+    profile = _profile
+    if profile is None:
+        yield
+        return
+    start = profile.enter()
+    try:
+        yield
+    finally:
+        profile.exit(name, start, rows)
+
+def event(name : str, **fields):
+    logger.debug("%s %s", name, fields)
+    if _profile is not None:
+        _profile.event(name, fields)
+
+def _run_profiled(allocations, func, *args):
+    with Profile(allocations=allocations) as profile:
+        result = func(*args)
+    return result, profile.stages, profile.events
+
+def submit(pool, func, *args) -> Future:
+    # pool.submit for process pools. Inside a Profile block the call is
+    # profiled in the worker too, and its stages are merged into the active
+    # Profile when it finishes.
+    profile = _profile
+    if profile is None:
+        return pool.submit(func, *args)
+
+    future = Future()
+    def done(remote):
+        try:
+            result, stages, events = remote.result()
+        except BaseException as err:
+            future.set_exception(err)
+            return
+        profile.merge(stages, events)
+        future.set_result(result)
+    pool.submit(_run_profiled, profile.allocations, func, *args).add_done_callback(done)
+    return future
+
+
 # ---------------------- Assorted helper functions -------------------------
 # See http://en.wikipedia.org/wiki/Ramer-Douglas-Peucker_algorithm for
 # the MATLAB version of this code.
@@ -21,531 +222,1088 @@ def point_line_distance(point, start, end):
         n = abs(delta_x * (start[1] - point[1]) - (start[0] - point[0]) * delta_y)
         return n / sqrt(delta_x**2 + delta_y**2)
 
+def line_distances(points, start, end):
+    # Vectorized point_line_distance for an (N, 2) array of points.
+    delta = end - start
+    norm = np.hypot(delta[0], delta[1])
+    if norm == 0:
+        return np.hypot(points[:, 0] - start[0], points[:, 1] - start[1])
+
+    n = np.abs(delta[0]*(start[1] - points[:, 1]) - (start[0] - points[:, 0])*delta[1])
+    return n / norm
+
+@instrumented()
+def rdp_indices(points, epsilon):
+    # Iterative RDP over an (N, 2) array. Returns the sorted indices of the
+    # kept points, so breakpoints never have to be looked up again by value.
+    points = np.asarray(points, dtype=float)
+    if len(points) < 3:
+        return np.arange(len(points))
+
+    keep = np.zeros(len(points), dtype=bool)
+    keep[[0, -1]] = True
+    stack = [(0, len(points) - 1)]
+    while stack:
+        start, end = stack.pop()
+        if end - start < 2:
+            continue
+
+        dists = line_distances(points[start + 1:end], points[start], points[end])
+        index = dists.argmax()
+        if dists[index] >= epsilon:
+            index += start + 1
+            keep[index] = True
+            stack.append((start, index))
+            stack.append((index, end))
+
+    return np.flatnonzero(keep)
+
 def rdp(points, epsilon):
-    dmax = 0.0
-    index = 0
-    for i in range(1, len(points) - 1):
-        d = point_line_distance(points[i], points[0], points[-1])
-        if d > dmax:
-            index = i
-            dmax = d
+    return [points[i] for i in rdp_indices(points, epsilon)]
 
-    return rdp(points[:index+1], epsilon)[:-1] + rdp(points[index:], epsilon)\
-           if dmax >= epsilon else [points[0], points[-1]]
+def rdp_segments(track_df, epsilon):
+    # Split a track into the straight runs between its RDP breakpoints.
+    idx = rdp_indices(track_df[['x', 'y']].values, epsilon)
+    return [track_df.iloc[start:end] for start, end in zip(idx[:-1], idx[1:])]
 
-def calc_velocity(track_df, px_per_mm, fps):
+# ----------------------------- Compact tracks ------------------------------
+# A TrackSet keeps the frame/x/y of many particles as one contiguous
+# float32 (rows, 3) array with per-particle row offsets. Tracks and their
+# segments are views into it, so a whole campaign costs little more than
+# its raw coordinates instead of a DataFrame per particle and segment.
 
-    # Convert px per mm to meter(s).
-    x_disp = [ufloat(element, 2)/(px_per_mm*1000) for element in track_df.x]
-    y_disp = [ufloat(element, 2)/(px_per_mm*1000) for element in track_df.y]
+class Track:
+    __slots__ = ('data', 'particle')
 
-    time_arr = [(track_df.iloc[i, 0] - track_df.iloc[i-1, 0])/fps for i in range(1, len(track_df))]
+    def __init__(self, data, particle=None):
+        self.data = data
+        self.particle = particle
 
-    pos_x = [x_disp[i] - x_disp[i - 1] for i in range(1, len(track_df))]
-    pos_y = [y_disp[i] - y_disp[i - 1] for i in range(1, len(track_df))]
-    velocity_arr = [y_pos/time for y_pos, time in zip(pos_y, time_arr)]
+    frame = property(lambda self: self.data[:, 0])
+    x = property(lambda self: self.data[:, 1])
+    y = property(lambda self: self.data[:, 2])
 
-    velocity_arr = velocity_arr[5:-5]
-    return sum(velocity_arr)/len(velocity_arr)
+    def __len__(self):
+        return len(self.data)
 
-def calc_charge(v_f, v_r):
-    b = 0.0082    # Pascal Meters
-    g = 9.80665  # meters per second squared
-    eta = ufloat(0.0000184, 0.0000004)  # viscosity of air in Ns/m^2.
-    # This comes from Appendix A, using a temp. of 23C.
+    def __getitem__(self, rows):
+        # Positional slice, as a view.
+        return Track(self.data[rows], self.particle)
+
+    def between(self, start=None, end=None):
+        # Frames start..end inclusive (None for an open end), like .loc on
+        # a frame-indexed DataFrame.
+        frame = self.frame
+        lo = 0 if start is None else np.searchsorted(frame, start, 'left')
+        hi = len(frame) if end is None else np.searchsorted(frame, end, 'right')
+        return self[lo:hi]
+
+    def to_frame(self) -> pd.DataFrame:
+        return pd.DataFrame({'x': self.x, 'y': self.y, 'particle': self.particle},
+                            index=pd.Index(self.frame.astype(np.int64), name='frame'))
+
+class TrackSet(Sequence):
+    __slots__ = ('data', 'offsets', 'particles')
+
+    def __init__(self, data, offsets, particles):
+        self.data = data
+        self.offsets = offsets
+        self.particles = particles
 
-    p = ufloat(1025.26, 0.1) * 100 # Quantity in hectopascals, converting to pascals.
-    plate_diff = ufloat(498, 2) # Measured, units in volts
-    plate_spacing = (ufloat(0.30, 0.001)*2.54)/100 # Caliper is in inches, so convert to meters.
-    rho = ufloat(863.4, 10.2)
+    @classmethod
+    def from_frames(cls, tracks):
+        # Pack a list of track DataFrames (load_tracks' output) into one array.
+        lengths = [len(track_df) for track_df in tracks]
+        offsets = np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64)
+        data = np.empty((offsets[-1], 3), dtype=np.float32)
+        for track_df, start, stop in zip(tracks, offsets[:-1], offsets[1:]):
+            data[start:stop, 0] = track_frames(track_df)
+            data[start:stop, 1] = track_df['x'].values
+            data[start:stop, 2] = track_df['y'].values
+        particles = np.array([track_df['particle'].iloc[0] if len(track_df) else -1
+                              for track_df in tracks])
+        return cls(data, offsets, particles)
+
+    @classmethod
+    def load(cls, addr : str, **kwargs):
+        return cls.from_frames(load_tracks(addr, **kwargs))
+
+    def __getitem__(self, i):
+        return Track(self.data[self.offsets[i]:self.offsets[i + 1]], self.particles[i])
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    @property
+    def nbytes(self):
+        return self.data.nbytes + self.offsets.nbytes + self.particles.nbytes
+
+def track_frames(track_df):
+    # Frame numbers of a track, whether 'frame' is a column or the index
+    # (as load_tracks and the track store give it), or a compact Track.
+    if isinstance(track_df, Track):
+        return track_df.frame
+    if 'frame' in track_df.columns:
+        return track_df['frame'].values
+    return track_df.index.values
+
+def take_rows(track_df, start, stop):
+    # Positional rows of a DataFrame or a compact Track.
+    if isinstance(track_df, Track):
+        return track_df[start:stop]
+    return track_df.iloc[start:stop]
+
+def velocity_px(frames, y_pos, fps, px_err=2):
+    # Trimmed mean vertical velocity of a track in px/s, with its error
+    # from the pixel positions alone.
+    frames, y_pos = np.asarray(frames, dtype=float), np.asarray(y_pos, dtype=float)
+
+    # Mirror the old velocity_arr[5:-5] trim on the per-step velocities.
+    steps = np.arange(1, len(y_pos))[5:-5]
+    if not len(steps):
+        # Nothing left after the trim (11 rows or fewer).
+        return math.nan, math.nan
+    weights = fps/(frames[steps] - frames[steps - 1])/len(steps)
+
+    # The mean velocity is linear in the pixel positions, so each position
+    # picks up a coefficient from the steps on either side of it and the
+    # (independent) pixel errors add in quadrature.
+    coeffs = np.zeros_like(y_pos)
+    np.add.at(coeffs, steps, weights)
+    np.subtract.at(coeffs, steps - 1, weights)
+    return coeffs.dot(y_pos), px_err*sqrt(coeffs.dot(coeffs))
+
+@instrumented()
+def calc_velocity(track_df, px_per_mm, fps, px_err=2):
+    mean_px = ufloat(*velocity_px(track_frames(track_df), np.asarray(track_df.y), fps, px_err))
+
+    # Convert px per mm to meter(s).
+    return mean_px/(px_per_mm*1000)
+
+@instrumented(rows=lambda args, result: 1)
+def calc_charge(v_f, v_r):
+    eta = ufloat(*ETA)
+    p = ufloat(*PRESSURE)
+    plate_diff = ufloat(*PLATE_DIFF)
+    plate_spacing = ufloat(*PLATE_SPACING)
+    rho = ufloat(*RHO)
 
     E = plate_diff/plate_spacing
 
     # Equations
-    b_over_2p = b/(2*p)
-    sec_term = (9*eta*v_f)/(2*g*rho)
+    b_over_2p = B/(2*p)
+    sec_term = (9*eta*v_f)/(2*G*rho)
 
     a = sqrt(b_over_2p*b_over_2p + sec_term) - b_over_2p
     m = (4*math.pi*(a**3)*rho)/3
-    q = (m*g*(v_f + v_r))/(E*v_f)
+    q = (m*G*(v_f + v_r))/(E*v_f)
 
     # Returns a in meters, mass in (grams?), and charge in coulombs
     return a, m, q
 
+# Terms of calc_charge that don't depend on the drop, worked out once.
+E = PLATE_DIFF[0]/PLATE_SPACING[0]
+B_OVER_2P = B/(2*PRESSURE[0])
+
+@instrumented(rows=lambda args, result: np.size(args[0]))
+def calc_charges(v_f, v_r, v_f_err=0, v_r_err=0, v_rel_err=0):
+    # Batched calc_charge over arrays of fall/rise velocities. The same
+    # linear error propagation is done analytically, treating every drop
+    # as independent just like separate calc_charge calls. v_rel_err is a
+    # relative error shared by both velocities of a drop (the px_per_mm
+    # calibration). Returns (nominal, sigma) array pairs for a, m and q.
+    v_f, v_r = np.asarray(v_f, dtype=float), np.asarray(v_r, dtype=float)
+
+    sec_term = (9*ETA[0]*v_f)/(2*G*RHO[0])
+    a, m, q = charge_formula(v_f, v_r, ETA[0], PRESSURE[0], PLATE_DIFF[0],
+                             PLATE_SPACING[0], RHO[0])
+    root = a + B_OVER_2P
+
+    # Partial derivatives of a with respect to each input, via b/2p and the
+    # second term under the root. A drop with v_f <= 0 has no radius, so
+    # everything about it stays NaN, quietly, as in charge_formula.
+    with np.errstate(invalid='ignore', divide='ignore'):
+        da_dbp = B_OVER_2P/root - 1
+        da_dsec = 1/(2*root)
+        da = {'v_f': da_dsec*sec_term/v_f,
+              'eta': da_dsec*sec_term/ETA[0],
+              'rho': -da_dsec*sec_term/RHO[0],
+              'p': -da_dbp*B_OVER_2P/PRESSURE[0],
+              'scale': da_dsec*sec_term}
+        dm = {key: 3*m/a*value for key, value in da.items()}
+        dm['rho'] = dm['rho'] + m/RHO[0]
+        dq = {key: q/m*value for key, value in dm.items()}
+        # q's own (v_f + v_r)/v_f factor doesn't change under a common scale.
+        dq['v_f'] = dq['v_f'] + q*(1/(v_f + v_r) - 1/v_f)
+        dq['v_r'] = q/(v_f + v_r)
+        dq['plate_diff'] = -q/PLATE_DIFF[0]
+        dq['plate_spacing'] = q/PLATE_SPACING[0]
+
+        sigmas = {'v_f': v_f_err, 'v_r': v_r_err, 'scale': v_rel_err, 'eta': ETA[1],
+                  'rho': RHO[1], 'p': PRESSURE[1], 'plate_diff': PLATE_DIFF[1],
+                  'plate_spacing': PLATE_SPACING[1]}
+        propagate = lambda partials: np.sqrt(sum((value*sigmas[key])**2
+                                                 for key, value in partials.items()))
+
+        return (a, propagate(da)), (m, propagate(dm)), (q, propagate(dq))
+
+# ------------------------- Monte Carlo uncertainties -------------------------
+# Opt-in alternative to the linearized errors above: every uncertain input
+# is drawn as a (draws, drops) array and pushed through the exact charge
+# formula, so the nonlinear sqrt/a**3 terms are handled properly. Velocity
+# is linear in the pixel positions, so drawing it from its pixel-noise
+# distribution is the same as drawing every position.
+
+def charge_formula(v_f, v_r, eta, p, plate_diff, plate_spacing, rho):
+    b_over_2p = B/(2*p)
+    sec_term = (9*eta*v_f)/(2*G*rho)
+    # No radius (NaN) for v_f <= 0.
+    with np.errstate(invalid='ignore', divide='ignore'):
+        a = np.sqrt(b_over_2p*b_over_2p + sec_term) - b_over_2p
+        m = (4*math.pi*(a**3)*rho)/3
+        q = (m*G*(v_f + v_r)*plate_spacing)/(plate_diff*v_f)
+    return a, m, q
+
+@instrumented(rows=lambda args, result: np.size(args[0]))
+def monte_carlo_charges(v_f_px, v_r_px, v_f_px_err, v_r_px_err, px_per_mm, draws=10000,
+                        percentiles=(16, 50, 84), seed=None, max_samples=5*10**6) -> dict:
+    # Velocities are in px/s and px_per_mm is a (value, error) pair. Drops
+    # are done in blocks, and each block's inputs are drawn max_samples at
+    # a time, so only the radius/mass/charge samples of a block (needed
+    # whole for the percentiles) scale with draws. Returns {'radius',
+    # 'mass', 'charge'} -> (len(percentiles), drops) arrays.
+    rng = np.random.default_rng(seed)
+    v_f_px, v_r_px = np.asarray(v_f_px, dtype=float), np.asarray(v_r_px, dtype=float)
+    v_f_px_err = np.broadcast_to(v_f_px_err, v_f_px.shape)
+    v_r_px_err = np.broadcast_to(v_r_px_err, v_r_px.shape)
+    draw = lambda const, shape: rng.normal(const[0], const[1], shape)
+
+    names = ('radius', 'mass', 'charge')
+    out = {name: np.empty((len(percentiles), len(v_f_px))) for name in names}
+    block = max(1, max_samples//draws)
+    for start in range(0, len(v_f_px), block):
+        drops = slice(start, start + block)
+        n = len(v_f_px[drops])
+        samples = {name: np.empty((draws, n)) for name in names}
+        step = max(1, max_samples//n)
+        for first in range(0, draws, step):
+            rows = slice(first, min(first + step, draws))
+            shape = (rows.stop - rows.start, n)
+            scale = draw(px_per_mm, (shape[0], 1))*1000
+            v_f = rng.normal(v_f_px[drops], v_f_px_err[drops], shape)/scale
+            v_r = rng.normal(v_r_px[drops], v_r_px_err[drops], shape)/scale
+            results = charge_formula(v_f, v_r, draw(ETA, shape), draw(PRESSURE, shape),
+                                     draw(PLATE_DIFF, shape), draw(PLATE_SPACING, shape),
+                                     draw(RHO, shape))
+            for name, result in zip(names, results):
+                samples[name][rows] = result
+        for name in names:
+            out[name][:, drops] = np.nanpercentile(samples[name], percentiles, axis=0)
+    return out
+
+# analyze_df's (valid, charge) for a pair with an empty or too short segment.
+SKIPPED = (None, None)
+
+@instrumented(rows=lambda args, result: len(args[0]) + len(args[1]))
 def analyze_df(df_fall, df_rise, px_per_mm, fps):
     if len(df_fall) and len(df_rise):
         v_fall = calc_velocity(df_fall, px_per_mm, fps)
         v_rise = -calc_velocity(df_rise, px_per_mm, fps)
-        if v_rise < 0:
+        if math.isnan(v_fall.n) or math.isnan(v_rise.n):
+            # Too short for a velocity.
+            return SKIPPED
+        if v_rise.n < 0:
             # Use this track to find our err from zero.
-            return False, calc_charge(v_fall, -abs(v_rise))[-1]
+            return False, calc_charge(v_fall, v_rise)[-1]
         # Else....
         return True, calc_charge(v_fall, v_rise)[-1]
     # Else..
-    return -1
+    return SKIPPED
 
-def load_tracks(addr : str) -> list:
-    data_arr = []
-    for file in glob.glob(addr):
-        print("Opening ", file)
-        temp_df = pd.read_csv(file, sep='\t', index_col='frame')
+# ---------------------------- Parallel analyze_df ----------------------------
+# Pairs are packed a chunk at a time into one float64 (rows, 3) frame/x/y
+# array plus row offsets, so workers receive a few flat arrays instead of
+# pickled DataFrames. Chunks come back in submission order.
+
+PAIR_STATUS = ('skipped', 'invalid', 'valid', 'failed')
+
+def pack_pairs(pairs):
+    # [(fall, rise), ...] -> (data, offsets), fall i at rows offsets[2i]
+    # to offsets[2i + 1] and rise i up to offsets[2i + 2].
+    segments = [segment for pair in pairs for segment in pair]
+    offsets = np.concatenate([[0], np.cumsum([len(s) for s in segments])]).astype(np.int64)
+    data = np.empty((offsets[-1], 3))
+    for segment, start, stop in zip(segments, offsets[:-1], offsets[1:]):
+        data[start:stop, 0] = track_frames(segment)
+        data[start:stop, 1] = np.asarray(segment.x)
+        data[start:stop, 2] = np.asarray(segment.y)
+    return data, offsets
+
+def _analyze_packed(data, offsets, px_per_mm, fps):
+    # Worker side: status codes (indices into PAIR_STATUS), charges and errors.
+    n = (len(offsets) - 1)//2
+    status, charge, charge_err = np.zeros(n, dtype=np.int8), np.full(n, np.nan), np.full(n, np.nan)
+    for i in range(n):
+        fall = Track(data[offsets[2*i]:offsets[2*i + 1]])
+        rise = Track(data[offsets[2*i + 1]:offsets[2*i + 2]])
+        try:
+            valid, q = analyze_df(fall, rise, px_per_mm, fps)
+        except (ValueError, ZeroDivisionError):
+            # A fall that isn't falling has no radius (sqrt of a negative).
+            status[i] = PAIR_STATUS.index('failed')
+            continue
+        if valid is None:
+            continue
+        if not (math.isfinite(q.n) and math.isfinite(q.s)):
+            status[i] = PAIR_STATUS.index('failed')
+            continue
+        status[i] = PAIR_STATUS.index('valid' if valid else 'invalid')
+        charge[i], charge_err[i] = q.n, q.s
+    return status, charge, charge_err
+
+@instrumented(rows=lambda args, result: len(result))
+def analyze_pairs(pairs, px_per_mm, fps, workers=None, chunk_size=None) -> pd.DataFrame:
+    # analyze_df over a list of (fall, rise) pairs on a process pool, one
+    # row per pair in input order. status is 'valid', 'invalid' (negative
+    # rise), 'skipped' (an empty or too short segment) or 'failed' (no
+    # charge, e.g. a fall that isn't falling); the last two have NaN charge.
+    pairs = list(pairs)
+    workers = workers or os.cpu_count()
+    chunk_size = chunk_size or max(1, -(-len(pairs)//(4*workers)))
+    chunks = [pack_pairs(pairs[start:start + chunk_size])
+              for start in range(0, len(pairs), chunk_size)]
+
+    if workers == 1 or len(chunks) <= 1:
+        results = [_analyze_packed(data, offsets, px_per_mm, fps) for data, offsets in chunks]
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = [submit(pool, _analyze_packed, data, offsets, px_per_mm, fps)
+                       for data, offsets in chunks]
+            results = [future.result() for future in futures]
+
+    status, charge, charge_err = (np.concatenate(arrays) for arrays in
+                                  zip(*results, (np.empty(0, np.int8), [], [])))
+    return pd.DataFrame({'status': pd.Categorical.from_codes(status, PAIR_STATUS),
+                         'charge': charge, 'charge_err': charge_err})
+
+# ------------------------- Automatic up/down segmentation -------------------------
+# Image y grows downwards, so a falling drop has a positive vertical
+# velocity. Reversals are taken from a moving average of the per-frame
+# velocity, with a dead band so that jitter around a stop doesn't count.
+
+def track_directions(frames, y_pos, window=15, min_speed=0.2, min_length=20):
+    # +1 (down) / -1 (up) per row of a track.
+    v = np.diff(y_pos)/np.diff(frames)
+    if not len(v):
+        return np.ones(len(y_pos), dtype=int)
+    # A kernel longer than the track would make 'same' return the kernel's
+    # length instead of the track's.
+    window = min(window, len(v))
+    smooth = np.convolve(v, np.ones(window)/window, mode='same')
+    sign = np.where(np.abs(smooth) > min_speed, np.sign(smooth), 0).astype(int)
+
+    def fill(sign):
+        # Carry the last direction over undecided steps, and the first
+        # decided direction back over any leading ones.
+        filled = sign[np.maximum.accumulate(np.where(sign != 0, np.arange(len(sign)), 0))]
+        first = np.flatnonzero(filled)
+        return np.where(filled == 0, sign[first[0]] if len(first) else 1, filled)
+
+    # Runs too short to be a real phase are absorbed into the one before.
+    sign = fill(sign)
+    starts = np.flatnonzero(np.diff(sign, prepend=0))
+    lengths = np.diff(starts, append=len(sign))
+    sign[np.repeat(lengths < min_length, lengths)] = 0
+    sign = np.append(fill(sign), 0)
+    sign[-1] = sign[-2]
+
+    # A phase whose trimmed mean velocity is against its label, or inside
+    # the dead band, is jitter of a nearly balanced drop rather than a real
+    # phase. It is absorbed into the one before (or after, for the first)
+    # and the merged phase is checked again.
+    frames, y_pos = np.asarray(frames, dtype=float), np.asarray(y_pos, dtype=float)
+    while True:
+        starts = np.flatnonzero(np.diff(sign, prepend=0))
+        stops = np.append(starts[1:], len(sign))
+        for start, stop in zip(starts, stops):
+            mean = velocity_px(frames[start:stop], y_pos[start:stop], 1)[0]
+            if len(starts) > 1 and mean*sign[start] <= min_speed:
+                sign[start:stop] = sign[start - 1] if start else sign[stop]
+                break
+        else:
+            return sign
 
-        for element in temp_df['particle'].unique():
-            data_arr.append(temp_df.loc[temp_df['particle'] == element])
+@instrumented(rows=lambda args, result: len(result))
+def segment_tracks(tracks, window=15, min_speed=0.2, min_length=20) -> pd.DataFrame:
+    # Label every up/down phase of every track. tracks is a list or a
+    # mapping of track DataFrames; start/stop are row positions (for .iloc)
+    # and start_frame/end_frame the inclusive frame range.
+    items = tracks.items() if isinstance(tracks, Mapping) else enumerate(tracks)
+    rows = []
+    for name, track_df in items:
+        frames = track_frames(track_df)
+        if not len(frames):
+            continue
+        sign = track_directions(frames, np.asarray(track_df.y), window, min_speed, min_length)
+        starts = np.flatnonzero(np.diff(sign, prepend=0))
+        stops = np.append(starts[1:], len(sign))
+        counts = {1: 0, -1: 0}
+        for start, stop in zip(starts, stops):
+            direction = 'down' if sign[start] > 0 else 'up'
+            rows.append((name, direction, counts[sign[start]], start, stop,
+                         frames[start], frames[stop - 1]))
+            counts[sign[start]] += 1
+
+    return pd.DataFrame(rows, columns=['track', 'direction', 'number', 'start', 'stop',
+                                       'start_frame', 'end_frame'])
+
+def slice_segments(tracks, segments) -> dict:
+    # The segment table as manifest-style keys, e.g. '3_down_1'.
+    return {'{}_{}_{}'.format(row.track, row.direction, row.number):
+            take_rows(tracks[row.track], row.start, row.stop)
+            for row in segments.itertuples()}
+
+
+@instrumented(rows=lambda args, result: len(result))
+def charge_table(tracks, segments, px_per_mm, fps, min_length=20, px_err=2,
+                 draws=0, seed=None) -> pd.DataFrame:
+    # Bulk version of the Analyze notebook's pairing loop. Each segment is
+    # paired with the one before it on the same track when their directions
+    # differ, skipping segments of min_length rows or fewer. Velocities are
+    # worked out once per segment and charges once for all pairs; 'valid'
+    # is analyze_df's flag (False when the rise came out negative), and is
+    # also False for a fall that isn't falling, which has no charge. With
+    # draws, Monte Carlo charge percentiles (16/50/84) are added as well.
+    scale = getattr(px_per_mm, 'n', px_per_mm)*1000
+    rel_err = getattr(px_per_mm, 's', 0)*1000/scale
+
+    segments = segments.reset_index(drop=True)
+    long_enough = (segments.stop - segments.start) > min_length
+    prev = segments.groupby('track')[['direction']].shift(1)['direction']
+    prev_long = long_enough.groupby(segments.track).shift(1, fill_value=False)
+    paired = long_enough & prev_long & prev.notna() & (prev != segments.direction)
+
+    current = np.flatnonzero(paired.values)
+    is_down = (segments.direction.values[current] == 'down')
+    fall = np.where(is_down, current, current - 1)
+    rise = np.where(is_down, current - 1, current)
+
+    used = np.union1d(fall, rise)
+    v, v_err = np.zeros(len(segments)), np.zeros(len(segments))
+    for i in used:
+        row = segments.iloc[i]
+        track_df = take_rows(tracks[row.track], row.start, row.stop)
+        v[i], v_err[i] = velocity_px(track_frames(track_df), np.asarray(track_df.y), fps, px_err)
+    v_px, v_px_err = v, v_err
+    v, v_err = v/scale, v_err/scale
+
+    v_fall, v_rise = v[fall], -v[rise]
+    (a, a_err), (m, m_err), (q, q_err) = calc_charges(v_fall, v_rise, v_err[fall],
+                                                      v_err[rise], rel_err)
+    with_scale = lambda value, err: np.sqrt(err**2 + (value*rel_err)**2)
+    table = pd.DataFrame({'track': segments.track.values[fall],
+                          'fall': fall, 'rise': rise,
+                          'v_fall': v_fall, 'v_fall_err': with_scale(v_fall, v_err[fall]),
+                          'v_rise': v_rise, 'v_rise_err': with_scale(v_rise, v_err[rise]),
+                          'radius': a, 'radius_err': a_err,
+                          'mass': m, 'mass_err': m_err,
+                          'charge': q, 'charge_err': q_err,
+                          'valid': (v_rise >= 0) & (v_fall > 0) & np.isfinite(q)})
+
+    if draws:
+        charge = monte_carlo_charges(v_px[fall], -v_px[rise], v_px_err[fall], v_px_err[rise],
+                                     (scale/1000, rel_err*scale/1000), draws, seed=seed)['charge']
+        table['charge_p16'], table['charge_p50'], table['charge_p84'] = charge
+    return table
+
+# ----------------------------- Elementary charge -----------------------------
+# Charges should cluster at integer multiples of e. Every candidate e on a
+# grid is scored by how well the charges line up with its multiples (a
+# weighted mean of cos(2 pi q/e), 1 for perfect quantization). Any e/k
+# scores as well as e does, so the largest candidate close to the best
+# score wins. The pick is then refined by weighted least squares of q = n e.
+
+def quantization_scores(charges, weights, candidates, block_size=10**7):
+    scores = np.empty(len(candidates))
+    step = max(1, block_size//max(1, len(charges)))
+    for start in range(0, len(candidates), step):
+        phase = np.cos(2*math.pi*charges[None, :]/candidates[start:start + step, None])
+        scores[start:start + step] = phase.dot(weights)/weights.sum()
+    return scores
+
+@instrumented(rows=lambda args, result: np.size(args[0]))
+def estimate_e(charges, sigmas=None, e_range=None, n_grid=2000, tolerance=0.05,
+               max_points=5000):
+    # Returns e as a ufloat and each drop's integer multiple of it. Drops
+    # with a non-finite charge or sigma are left out, with multiple 0.
+    all_charges = np.asarray(charges, dtype=float)
+    finite = np.isfinite(all_charges)
+    if sigmas is not None:
+        sigmas = np.broadcast_to(np.asarray(sigmas, dtype=float), all_charges.shape)
+        finite &= np.isfinite(sigmas)
+        sigmas = sigmas[finite]
+    charges = all_charges[finite]
+    if not len(charges):
+        raise ValueError('estimate_e needs at least one finite charge')
+    if sigmas is None or not np.all(sigmas > 0):
+        sigmas = None
+        weights = np.ones_like(charges)
+    else:
+        weights = 1/sigmas**2
+
+    # By default e is looked for up to half again the smaller charges, and
+    # down to a fifteenth of that. The 10th percentile stands in for the
+    # smallest charge so that a few spurious tiny ones can't pull the range
+    # below e; a range running past e only adds candidates that score worse.
+    positive = charges[charges > 0]
+    if e_range is None and not len(positive):
+        raise ValueError('estimate_e needs positive charges (or an e_range)')
+    if e_range is None:
+        high = np.percentile(positive, 10)*1.5
+        e_range = (high/15, high)
+    low, high = e_range
+
+    # Scoring cost is candidates x points, so big samples are scored as a
+    # fine weighted histogram instead of drop by drop.
+    points, point_weights = charges, weights
+    if len(charges) > max_points:
+        point_weights, edges = np.histogram(charges, bins=max_points, weights=weights)
+        points = (edges[:-1] + edges[1:])/2
+
+    candidates = np.linspace(low, high, n_grid)
+    scores = quantization_scores(points, point_weights, candidates)
+    e_grid = candidates[np.flatnonzero(scores >= scores.max() - tolerance)[-1]]
+
+    multiples = np.rint(charges/e_grid).astype(int)
+    used = multiples > 0
+    if not used.any():
+        raise ValueError('no charge is a positive multiple of e = {:.3e}'.format(e_grid))
+    norm = (weights[used]*multiples[used]**2).sum()
+    e = (weights[used]*multiples[used]*charges[used]).sum()/norm
+    if sigmas is None:
+        # No per-drop errors, so take the scatter about the fit instead.
+        resid = charges[used] - multiples[used]*e
+        e_err = sqrt(resid.dot(resid)/max(1, used.sum() - 1)/norm)
+    else:
+        e_err = 1/sqrt(norm)
+    all_multiples = np.zeros(len(all_charges), dtype=int)
+    all_multiples[finite] = multiples
+    return ufloat(e, e_err), all_multiples
+
+@instrumented(rows=lambda args, result: len(result))
+def read_track_file(file):
+    event('open_track_file', file=file)
+    return pd.read_csv(file, sep='\t', index_col='frame')
+
+def split_particles(temp_df, views=False):
+    # One groupby pass, keeping particles in order of first appearance.
+    if not views:
+        return [group for _, group in temp_df.groupby('particle', sort=False)]
+
+    # Reorder the file once so every particle is a contiguous block, then
+    # hand out positional slices of it instead of a copy per particle.
+    codes, uniques = pd.factorize(temp_df['particle'])
+    order = np.argsort(codes, kind='stable')
+    bounds = np.searchsorted(codes[order], np.arange(len(uniques) + 1))
+    temp_df = temp_df.iloc[order]
+    return [temp_df.iloc[start:end] for start, end in zip(bounds[:-1], bounds[1:])]
+
+@instrumented(rows=lambda args, result: sum(map(len, result)))
+def load_tracks(addr : str, workers : int = 8, views : bool = False, store=None) -> list:
+    if store is not None:
+        # The store only knows whole run directories, so the file part has
+        # to be the usual pattern; the directory part may still be a glob.
+        directory, name = os.path.split(os.path.relpath(addr, store.base_addr))
+        if name != 'track*.csv':
+            raise ValueError("a track store serves '<run dir>/track*.csv' patterns, not " + addr)
+        return [track for run in store.directories(directory) for track in store.tracks(run)]
+
+    # Files are read concurrently, but results keep the glob's order.
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        all_dfs = list(pool.map(read_track_file, glob.glob(addr)))
+
+    data_arr = []
+    for temp_df in all_dfs:
+        data_arr.extend(split_particles(temp_df, views))
     return data_arr
 
-def load_all_trajectories(base_addr : str) -> dict:
-    t = lambda x: int(x * 30)
-    run_0, run_1, run_2 = load_tracks(base_addr + os.path.normpath('/Trajectories/df14/track*.csv'))
-    run_3, run_4 = load_tracks(base_addr + os.path.normpath('/Trajectories/df13/track*.csv'))
-    run_5 = load_tracks(base_addr + os.path.normpath('/Trajectories/df12/track*.csv'))[0]
-    run_6, run_7, run_8, run_9 = load_tracks(base_addr + os.path.normpath('/Trajectories/df11/track*.csv'))
-    run_10 = load_tracks(base_addr + os.path.normpath('/Trajectories/df9/track*.csv'))[0]
-    run_11 = load_tracks(base_addr + os.path.normpath('/Trajectories/df8/track*.csv'))[0]
-    run_12, run_13, run_14 = load_tracks(base_addr + os.path.normpath('/Trajectories/df7/track*.csv'))
-    df2_0, df2_1, df2_2, df2_3, df2_4, df2_5, df2_6, df2_7, df2_8, df2_9 = load_tracks(base_addr + '/Trajectories/df2/track*.csv')
-    df3_0, df3_1, df3_2, df3_3 = load_tracks(base_addr + '/Trajectories/df3/track*.csv')
-    df4_0 = load_tracks(base_addr + '/Trajectories/df4/track*.csv')[0]
-    df5_0, df5_1, df5_2, df5_3, df5_4, df5_5, df5_6, df5_7, df5_8 = load_tracks(base_addr + '/Trajectories/df5/track*.csv')
-    df6_0, df6_1, df6_2, df6_3, df6_4, df6_5, df6_6, df6_7, df6_8, df6_9, df6_10 = load_tracks(base_addr + '/Trajectories/df6/track*.csv')
-    df15_0, df15_1, df15_2 = load_tracks(base_addr + '/vids/df15/track*.csv')
-    df16_0 = load_tracks(base_addr + '/vids/df16/track*.csv')[0]
-    df17_0, df17_1, df17_2, df17_3, df17_4, df17_5, df17_6 = load_tracks(base_addr + '/vids/df17/track*.csv')
-    df18_0, df18_1, df18_2, df18_3, df18_4, df18_5, df18_6, df18_7, df18_8, df18_9 = load_tracks(base_addr + '/vids/df18/track*.csv')
-    df19_0, df19_1, df19_2, df19_3, df19_4, df19_5, df19_6, df19_7, df19_8, df19_9, df19_10 = load_tracks(base_addr + '/vids/df19/track*.csv')
-
-
-    return {'run_0_up_0': run_0.loc[t(3):t(10)],
-            'run_0_down_0': run_0.loc[t(10):t(20)],
-            'run_0_up_1': run_0.loc[t(20):t(25)],
-            'run_0_down_1': run_0.loc[t(25):t(41)],
-            'run_0_up_2': run_0.loc[t(41):t(45)],
-            'run_0_down_3': run_0.loc[t(45):t(55)],
-            'run_0_up_3': run_0.loc[t(55):t(58)],
-            'run_0_down_4': run_0.loc[t(58):],
-            'run_1_up_0' : run_1.loc[t(3):t(10)],
-            'run_1_down_0' : run_1.loc[t(10):t(20)],
-            'run_1_up_1' : run_1.loc[t(20):t(25)],
-            'run_1_down_1' : run_1.loc[t(25):t(41)],
-            'run_1_up_2' : run_1.loc[t(41):t(45)],
-            'run_1_down_3' : run_1.loc[t(45):t(55)],
-            'run_1_up_3' : run_1.loc[t(55):t(58)],
-            'run_1_down_4' : run_1.loc[t(58):],
-            'run_2_up_0' : run_2.loc[t(3):t(10)],
-            'run_2_down_0' : run_2.loc[t(10):t(20)],
-            'run_2_up_1' : run_2.loc[t(20):t(25)],
-            'run_2_down_1' : run_2.loc[t(25):t(41)],
-            'run_2_up_2' : run_2.loc[t(41):t(45)],
-            'run_2_down_3' : run_2.loc[t(45):t(55)],
-            'run_2_up_3' : run_2.loc[t(55):t(58)],
-            'run_2_down_4' : run_2.loc[t(58):],
-            'run_3_gravity' : run_3.loc[:t(5)],
-            'run_3_up_0' : run_3.loc[t(5):t(10)],
-            'run_3_down_0' : run_3.loc[t(10):t(20)],
-            'run_3_up_1' : run_3.loc[t(20):t(25)],
-            'run_3_down_1' : run_3.loc[t(25):t(33)],
-            'run_3_up_2' : run_3.loc[t(33):t(40)],
-            'run_3_down_2' : run_3.loc[t(40):t(45)],
-            'run_3_up_3' : run_3.loc[t(45):t(50)],
-            'run_3_down_3' : run_3.loc[t(50):t(57)],
-            'run_3_up_4' : run_3.loc[t(57):t(62)],
-            'run_3_down_4' : run_3.loc[t(62):t(67)],
-            'run_4_gravity' : run_4.loc[:t(5)],
-            'run_4_up_0' : run_4.loc[t(5):t(10)],
-            'run_4_down_0' : run_4.loc[t(10):t(20)],
-            'run_4_up_1' : run_4.loc[t(20):t(25)],
-            'run_4_down_1' : run_4.loc[t(25):t(33)],
-            'run_4_up_2' : run_4.loc[t(33):t(40)],
-            'run_4_down_2' : run_4.loc[t(40):t(45)],
-            'run_4_up_3' : run_4.loc[t(45):t(50)],
-            'run_4_down_4' : run_4.loc[t(50):t(57)],
-            'run_4_up_4' : run_4.loc[t(57):t(62)],
-            'run_4_down_3' : run_4.loc[t(62):t(67)],
-            'run_5_gravity' : run_5.loc[:t(5)],
-            'run_5_up_0' : run_5.loc[t(5):t(12)],
-            'run_5_down_0' : run_5.loc[t(12):t(25)],
-            'run_5_up_1' : run_5.loc[t(25):t(34)],
-            'run_5_down_1' : run_5.loc[t(34):t(41)],
-            'run_5_up_2' : run_5.loc[t(41):t(47)],
-            'run_5_down_2' : run_5.loc[t(47):],
-            'run_6_gravity' : run_6.loc[:t(3)],
-            'run_6_up_0' : run_6.loc[t(3):t(14)],
-            'run_6_down_0' : run_6.loc[t(14):t(20)],
-            'run_6_up_1' : run_6.loc[t(20):t(30)],
-            'run_6_down_1' : run_6.loc[t(30):t(35)],
-            'run_6_up_2' : run_6.loc[t(35):t(44)],
-            'run_6_down_2' : run_6.loc[t(44):t(50)],
-            'run_6_up_3' : run_6.loc[t(50):t(55)],
-            'run_6_down_3' : run_6.loc[t(55):],
-            'run_7_gravity' : run_7.loc[:t(3)],
-            'run_7_up_0' : run_7.loc[t(3):t(14)],
-            'run_7_down_0' : run_7.loc[t(14):t(20)],
-            'run_7_up_1' : run_7.loc[t(20):t(30)],
-            'run_7_down_1' : run_7.loc[t(30):t(35)],
-            'run_7_up_2' : run_7.loc[t(35):t(44)],
-            'run_7_down_2' : run_7.loc[t(44):t(50)],
-            'run_7_up_3' : run_7.loc[t(50):t(55)],
-            'run_7_down_3' : run_7.loc[t(55):],
-            'run_8_gravity' : run_8.loc[:t(3)],
-            'run_8_up_0' : run_8.loc[t(3):t(14)],
-            'run_8_down_0' : run_8.loc[t(14):t(20)],
-            'run_8_up_1' : run_8.loc[t(20):t(30)],
-            'run_8_down_1' : run_8.loc[t(30):t(35)],
-            'run_8_up_2' : run_8.loc[t(35):t(44)],
-            'run_8_down_2' : run_8.loc[t(44):t(50)],
-            'run_8_up_3' : run_8.loc[t(50):t(55)],
-            'run_8_down_3' : run_8.loc[t(55):],
-            'run_9_gravity' : run_9.loc[:t(3)],
-            'run_9_up_0' : run_9.loc[t(3):t(14)],
-            'run_9_down_0' : run_9.loc[t(14):t(20)],
-            'run_9_up_1' : run_9.loc[t(20):t(30)],
-            'run_9_down_1' : run_9.loc[t(30):t(35)],
-            'run_9_up_2' : run_9.loc[t(35):t(44)],
-            'run_9_down_2' : run_9.loc[t(44):t(50)],
-            'run_9_up_3' : run_9.loc[t(50):t(55)],
-            'run_9_down_3' : run_9.loc[t(55):],
-            'run_10_gravity' : run_10.loc[:t(5)],
-            'run_10_up_0' : run_10.loc[t(5):t(13)],
-            'run_10_down_0' : run_10.loc[t(13):t(22)],
-            'run_10_up_1' : run_10.loc[t(22):t(29)],
-            'run_10_down_1' : run_10.loc[t(29):t(43)],
-            'run_10_up_2' : run_10.loc[t(43):t(49)],
-            'run_10_down_2' : run_10.loc[t(49):],
-            'run_11_gravity' : run_11.loc[:t(7)],
-            'run_11_up_0' : run_11.loc[t(7):t(11)],
-            'run_11_down_0' : run_11.loc[t(11):t(20)],
-            'run_11_up_1' : run_11.loc[t(20):t(25)],
-            'run_11_down_1' : run_11.loc[t(25):t(35)],
-            'run_11_up_2' : run_11.loc[t(35):t(39)],
-            'run_11_down_2' : run_11.loc[t(39):t(45)],
-            'run_11_up_3' : run_11.loc[t(45):t(50)],
-            'run_11_down_3' : run_11.loc[t(50):],
-            'run_12_gravity' : run_12.loc[:t(4)],
-            'run_12_up_0' : run_12.loc[:t(4):t(9)],
-            'run_12_down_0' : run_12.loc[t(9):t(28)],
-            'run_12_up_1' : run_12.loc[:t(28):t(30)],
-            'run_12_down_1' : run_12.loc[t(30):t(40)],
-            'run_12_up_2' : run_12.loc[:t(40):t(43)],
-            'run_12_down_2' : run_12.loc[t(43):t(55)],
-            'run_12_up_3' : run_12.loc[:t(55):t(57)],
-            'run_12_down_3' : run_12.loc[t(57):],
-            'run_13_gravity' : run_13.loc[:t(4)],
-            'run_13_up_0' : run_13.loc[:t(4):t(9)],
-            'run_13_down_0' : run_13.loc[t(9):t(28)],
-            'run_13_up_1' : run_13.loc[:t(28):t(30)],
-            'run_13_down_1' : run_13.loc[t(30):t(40)],
-            'run_13_up_2' : run_13.loc[:t(40):t(43)],
-            'run_13_down_2' : run_13.loc[t(43):t(55)],
-            'run_13_up_3' : run_13.loc[:t(55):t(57)],
-            'run_13_down_3' : run_13.loc[t(57):],
-            'run_14_gravity' : run_14.loc[:t(4)],
-            'run_14_up_0' : run_14.loc[:t(4):t(9)],
-            'run_14_down_0' : run_14.loc[t(9):t(28)],
-            'run_14_up_1' : run_14.loc[:t(28):t(30)],
-            'run_14_down_1' : run_14.loc[t(30):t(40)],
-            'run_14_up_2' : run_14.loc[:t(40):t(43)],
-            'run_14_down_2' : run_14.loc[t(43):t(55)],
-            'run_14_up_3' : run_14.loc[:t(55):t(57)],
-            'run_14_down_3' : run_14.loc[t(57):],
-            'df2_0_up_0' : df2_0.loc[t(55):t(60)],
-            'df2_0_down_1' : df2_0.loc[t(60):],
-            'df2_1_down_0' : df2_1.loc[:t(6)],
-            'df2_1_up_0' : df2_1.loc[t(6):t(17)],
-            'df2_1_down_1' : df2_1.loc[t(17):t(29)],
-            'df2_1_up_1' : df2_1.loc[t(29):t(34)],
-            'df2_1_down_2' : df2_1.loc[t(34):t(44)],
-            'df2_2_up_0' : df2_2.loc[t(55):t(60.5)],
-            'df2_2_down_1' : df2_2.loc[t(60.5):],
-            'df2_3_down_0' : df2_3.loc[:t(6)],
-            'df2_3_up_0' : df2_3.loc[t(6):t(17)],
-            'df2_4_down_0' : df2_4.loc[t(34):t(44)],
-            'df2_4_up_0' : df2_4.loc[t(44):t(48)],
-            'df2_4_down_1' : df2_4.loc[t(48):t(55)],
-            'df2_4_up_1' : df2_4.loc[t(55):t(60.5)],
-            'df2_4_down_2' : df2_4.loc[t(60.5):],
-            'df2_5_down_0' : df2_5.loc[t(16):t(29)],
-            'df2_5_up_0' : df2_5.loc[t(29):t(34)],
-            'df2_5_down_1' : df2_5.loc[t(34):t(44)],
-            'df2_5_up_1' : df2_5.loc[t(44):t(48)],
-            'df2_6_down_0' : df2_6.loc[t(34):t(44)],
-            'df2_6_up_0' : df2_6.loc[t(44):t(48)],
-            'df2_6_down_1' : df2_6.loc[t(48):t(55)],
-            'df2_6_up_1' : df2_6.loc[t(55):t(60.)],
-            'df2_6_down_2' : df2_6.loc[t(60.5):],
-            'df2_7_down_0' : df2_7.loc[t(34):t(44)],
-            'df2_7_up_0' : df2_7.loc[t(44):t(48)],
-            'df2_7_down_1' : df2_7.loc[t(48):t(55)],
-            'df2_7_up_1' : df2_7.loc[t(55):t(60.5)],
-            'df2_7_down_2' : df2_7.loc[t(60.5):],
-            'df2_8_down_0' : df2_8.loc[t(34):t(44)],
-            'df2_8_up_0' : df2_8.loc[t(44):t(48)],
-            'df2_8_down_1' : df2_8.loc[t(48):t(55)],
-            'df2_8_up_1' : df2_8.loc[t(55):t(60.5)],
-            'df2_8_down_2' : df2_8.loc[t(60.5):],
-            'df2_9_down_0' : df2_9.loc[t(16):t(29)],
-            'df2_9_up_0' : df2_9.loc[t(29):t(34)],
-            'df2_9_down_1' : df2_9.loc[t(34):t(44)],
-            'df2_9_up_1' : df2_9.loc[t(44):t(48)],
-            'df2_9_down_2' : df2_9.loc[t(48):t(55)],
-            'df2_9_up_2' : df2_9.loc[t(55):t(60.5)],
-            'df2_9_down_3' : df2_9.loc[t(60.5):],
-            'df3_0_up_0' : df3_0.loc[t(6):t(10)],
-            'df3_0_down_1' : df3_0.loc[t(10):t(26)],
-            'df3_1_down_0' : df3_1.loc[:t(6)],
-            'df3_1_up_0' : df3_1.loc[t(6):t(10)],
-            'df3_1_down_1' : df3_1.loc[t(10):t(26)],
-            'df3_1_up_1' : df3_1.loc[t(26):t(29)],
-            'df3_2_down_0' : df3_2.loc[:t(6)],
-            'df3_2_up_0' : df3_2.loc[t(6):t(10)],
-            'df3_2_down_1' : df3_2.loc[t(10):t(26)],
-            'df3_2_up_1' : df3_2.loc[t(26):t(29)],
-            'df3_2_down_2' : df3_2.loc[t(29):t(46)],
-            'df3_3_down_0' : df3_3.loc[:t(6)],
-            'df3_3_up_0' : df3_3.loc[t(6):t(10)],
-            'df3_3_down_1' : df3_3.loc[t(10):t(26)],
-            'df4_0_down_0' : df4_0.loc[:t(4)],
-            'df4_0_up_0' : df4_0.loc[t(4):t(17)],
-            'df4_0_down_1' : df4_0.loc[t(17):t(31)],
-            'df4_0_up_1' : df4_0.loc[t(31):t(41)],
-            'df4_0_down_2' : df4_0.loc[t(41):t(52)],
-            'df4_0_up_2' : df4_0.loc[t(52):t(60)],
-            'df4_0_down_3' : df4_0.loc[t(60):t(71)],
-            'df4_0_up_3' : df4_0.loc[t(71):t(79)],
-            'df5_0_down_0' : df5_0.loc[t(56):t(65)],
-            'df5_0_up_0' : df5_0.loc[t(65):t(70)],
-            'df5_0_down_1' : df5_0.loc[t(70):],
-            'df5_1_up_0' : df5_1.loc[t(5):t(11)],
-            'df5_1_down_1' : df5_1.loc[t(11):t(17)],
-            'df5_2_down_0' : df5_2.loc[t(56):t(65)],
-            'df5_2_up_0' : df5_2.loc[t(65):t(70)],
-            'df5_3_down_0' : df5_3.loc[:t(5)],
-            'df5_3_up_0' : df5_3.loc[t(5):t(11)],
-            'df5_4_down_0' : df5_4.loc[t(41):t(50)],
-            'df5_4_up_0' : df5_4.loc[t(50):t(56)],
-            'df5_5_down_0' : df5_5.loc[:t(5)],
-            'df5_5_up_0' : df5_5.loc[t(5):t(11)],
-            'df5_5_down_1' : df5_5.loc[t(11):t(17)],
-            'df5_5_up_1' : df5_5.loc[t(17):t(20)],
-            'df5_5_down_2' : df5_5.loc[t(20):t(35)],
-            'df5_6_down_0' : df5_6.loc[t(20):t(35)],
-            'df5_6_up_0' : df5_6.loc[t(35):t(41)],
-            'df5_6_down_1' : df5_6.loc[t(41):t(50)],
-            'df5_7_down_0' : df5_7.loc[:t(5)],
-            'df5_7_up_0' : df5_7.loc[t(5):t(11)],
-            'df5_7_down_1' : df5_7.loc[t(11):t(17)],
-            'df5_7_up_1' : df5_7.loc[t(17):t(20)],
-            'df5_7_down_2' : df5_7.loc[t(20):t(35)],
-            'df5_7_up_2' : df5_7.loc[t(35):t(41)],
-            'df5_8_down_0' : df5_8.loc[:t(5)],
-            'df5_8_up_0' : df5_8.loc[t(5):t(11)],
-            'df5_8_down_1' : df5_8.loc[t(11):t(17)],
-            'df5_8_up_1' : df5_8.loc[t(17):t(20)],
-            'df5_8_down_2' : df5_8.loc[t(20):t(35)],
-            'df5_8_up_2' : df5_8.loc[t(35):t(41)],
-            'df5_8_down_3' : df5_8.loc[t(41):t(50)],
-            'df5_8_up_3' : df5_8.loc[t(50):t(56)],
-            'df5_8_down_4' : df5_8.loc[t(56):t(64)],
-            'df5_8_up_4' : df5_8.loc[t(64):t(70)],
-            'df6_0_down_0' : df6_0.loc[t(50):t(65)],
-            'df6_0_up_0' : df6_0.loc[t(65):t(68.5)],
-            'df6_0_down_1' : df6_0.loc[t(68.5):],
-            'df6_1_down_0' : df6_1.loc[:t(5)],
-            'df6_1_up_0' : df6_1.loc[t(5):t(11)],
-            'df6_1_down_1' : df6_1.loc[t(11):t(30.5)],
-            'df6_1_up_1' : df6_1.loc[t(30.5):t(33)],
-            'df6_1_down_2' : df6_1.loc[t(33):t(47)],
-            'df6_1_up_2' : df6_1.loc[t(47):t(50)],
-            'df6_1_down_3' : df6_1.loc[t(50):t(65)],
-            'df6_2_down_0' : df6_2.loc[:t(5)],
-            'df6_2_up_0' : df6_2.loc[t(5):t(11)],
-            'df6_2_down_1' : df6_2.loc[t(11):t(30.5)],
-            'df6_2_up_1' : df6_2.loc[t(30.5):t(33)],
-            'df6_2_down_2' : df6_2.loc[t(33):t(47)],
-            'df6_3_down_0' : df6_3.loc[t(11):t(30.5)],
-            'df6_3_up_0' : df6_3.loc[t(30.5):t(33)],
-            'df6_3_down_1' : df6_3.loc[t(33):t(47)],
-            'df6_3_up_1' : df6_3.loc[t(47):t(50)],
-            'df6_3_down_2' : df6_3.loc[t(50):t(65)],
-            'df6_3_up_2' : df6_3.loc[t(65):t(68.5)],
-            'df6_3_down_3' : df6_3.loc[t(68.5):],
-            'df6_4_down_0' : df6_4.loc[t(11):t(30.5)],
-            'df6_4_up_0' : df6_4.loc[t(30.5):t(33)],
-            'df6_4_down_1' : df6_4.loc[t(33):t(47)],
-            'df6_4_up_1' : df6_4.loc[t(47):t(50)],
-            'df6_4_down_2' : df6_4.loc[t(50):t(65)],
-            'df6_4_up_2' : df6_4.loc[t(65):t(68.5)],
-            'df6_4_down_3' : df6_4.loc[t(68.5):],
-            'df6_5_down_0' : df6_5.loc[t(11):t(30.5)],
-            'df6_5_up_0' : df6_5.loc[t(30.5):t(33)],
-            'df6_5_down_1' : df6_5.loc[t(33):t(47)],
-            'df6_5_up_1' : df6_5.loc[t(47):t(50)],
-            'df6_5_down_2' : df6_5.loc[t(50):t(65)],
-            'df6_5_up_2' : df6_5.loc[t(65):t(68.5)],
-            'df6_5_down_3' : df6_5.loc[t(68.5):],
-            'df6_6_down_0' : df6_6.loc[t(33):t(47)],
-            'df6_6_up_0' : df6_6.loc[t(47):t(50)],
-            'df6_6_down_1' : df6_6.loc[t(50):t(65)],
-            'df6_7_down_0' : df6_7.loc[t(33):t(47)],
-            'df6_7_up_0' : df6_7.loc[t(47):t(50)],
-            'df6_7_down_1' : df6_7.loc[t(50):t(65)],
-            'df6_7_up_1' : df6_7.loc[t(65):t(68.5)],
-            'df6_7_down_2' : df6_7.loc[t(68.5):],
-            'df6_8_down_0' : df6_8.loc[t(33):t(47)],
-            'df6_8_up_0' : df6_8.loc[t(47):t(50)],
-            'df6_8_down_1' : df6_8.loc[t(50):t(65)],
-            'df6_8_up_1' : df6_8.loc[t(65):t(68.5)],
-            'df6_9_down_0' : df6_9.loc[t(50):t(65)],
-            'df6_9_up_0' : df6_9.loc[t(65):t(68.5)],
-            'df6_9_down_1' : df6_9.loc[t(68.5):],
-            'df6_10_down_0' : df6_10.loc[t(50):t(65)],
-            'df6_10_up_0' : df6_10.loc[t(65):t(68.5)],
-            'df6_10_down_1' : df6_10.loc[t(68.5):],
-            'df15_0_down_0' : df15_0.loc[:t(4)],
-            'df15_0_up_0' : df15_0.loc[t(4):t(9)],
-            'df15_0_down_1' : df15_0.loc[t(9):t(19)],
-            'df15_0_up_1' : df15_0.loc[t(19):t(27)],
-            'df15_0_down_2' : df15_0.loc[t(27):],
-            'df15_1_down_0' : df15_1.loc[:t(4)],
-            'df15_1_up_0' : df15_1.loc[t(4):t(9)],
-            'df15_1_down_1' : df15_1.loc[t(9):t(19)],
-            'df15_1_up_1' : df15_1.loc[t(19):t(27)],
-            'df15_1_down_2' : df15_1.loc[t(27):],
-            'df15_2_down_0' : df15_2.loc[:t(4)],
-            'df15_2_up_0' : df15_2.loc[t(4):t(9)],
-            'df15_2_down_1' : df15_2.iloc[t(9):t(19)],
-            'df15_2_up_1' : df15_2.loc[t(19):t(27)],
-            'df15_2_down_2' : df15_2.loc[t(27):],
-            'df16_0_down_0' : df16_0.loc[:t(6)],
-            'df16_0_up_0' : df16_0.loc[t(6):t(21)],
-            'df16_0_down_1' : df16_0.loc[t(21):t(34)], # Misaligning data
-            'df16_0_up_1' : df16_0.loc[t(34):t(41)],
-            'df16_0_down_2' : df16_0.loc[t(41):],
-            'df17_0_down_0' : df17_0.loc[:t(6.2)],
-            'df17_0_up_0' : df17_0.loc[t(6.2):t(12)],
-            'df17_0_down_1' : df17_0.loc[t(12):t(27.2)],
-            'df17_0_up_1' : df17_0.loc[t(27.2):t(33.5)],
-            'df17_0_down_2' : df17_0.loc[t(34):t(45.5)],
-            'df17_0_up_2' : df17_0.loc[t(45.5):t(48)],
-            'df17_0_down_3' : df17_0.loc[t(48):],
-            'df17_1_down_0' : df17_1.loc[:t(6.2)],
-            'df17_1_up_0' : df17_1.loc[t(6.2):t(12)],
-            'df17_1_down_1' : df17_1.loc[t(12):t(27.2)],
-            'df17_2_down_0' : df17_2.loc[:t(6.2)],
-            'df17_2_up_0' : df17_2.loc[t(6.2):t(12)],
-            'df17_2_down_1' : df17_2.loc[t(12):t(27.2)],
-            'df17_2_up_1' : df17_2.loc[t(27.2):t(33.5)],
-            'df17_2_down_2' : df17_2.loc[t(34):t(45.5)],
-            'df17_3_down_0' : df17_3.loc[:t(6.2)],
-            'df17_3_up_0' : df17_3.loc[t(6.2):t(12)],
-            'df17_3_down_1' : df17_3.loc[t(12):t(27.2)],
-            'df17_3_up_1' : df17_3.loc[t(27.2):t(33.5)],
-            'df17_4_up_0' : df17_4.loc[t(6.2):t(12)],
-            'df17_4_down_1' : df17_4.loc[t(12):t(27.2)],
-            'df17_4_up_1' : df17_4.loc[t(27.2):t(33.5)],
-            'df17_4_down_2' : df17_4.loc[t(34):t(45.5)],
-            'df17_4_up_2' : df17_4.loc[t(45.5):t(48)],
-            'df17_4_down_3' : df17_4.loc[t(48):],
-            'df17_5_down_0' : df17_0.loc[:t(6.2)],
-            'df17_5_up_0' : df17_0.loc[t(6.2):t(12)],
-            'df17_5_down_1' : df17_0.loc[t(12):t(27.2)],
-            'df17_5_up_1' : df17_0.loc[t(27.2):t(33.5)],
-            'df17_5_down_2' : df17_0.loc[t(34):t(45.5)],
-            'df17_5_up_2' : df17_0.loc[t(45.5):t(48)],
-            'df17_5_down_3' : df17_0.loc[t(48):],
-            'df17_6_down_0' : df17_0.loc[:t(6.2)],
-            'df17_6_up_0' : df17_0.loc[t(6.2):t(12)],
-            'df17_6_down_1' : df17_0.loc[t(12):t(27.2)], # Misaligning data
-            'df17_6_up_1' : df17_0.loc[t(27.2):t(33.5)],
-            'df17_6_down_2' : df17_0.loc[t(34):t(45.5)],
-            'df17_6_up_2' : df17_0.loc[t(45.5):t(48)],
-            'df17_6_down_3' : df17_0.loc[t(48):],
-            'df18_0_down_0' : df18_0.loc[:t(7.8)],
-            'df18_0_up_0' : df18_0.loc[t(7.8):t(11.5)],
-            'df18_0_down_1' : df18_0.loc[t(11.5):t(24)],
-            'df18_0_up_1' : df18_0.loc[t(24):t(30)],
-            'df18_1_down_0' : df18_1.loc[:t(7.8)],
-            'df18_1_up_0' : df18_1.loc[t(7.8):t(11.5)],
-            'df18_1_down_1' : df18_1.loc[t(11.5):t(24)],
-            'df18_1_up_1' : df18_1.loc[t(24):t(30)],
-            'df18_1_down_2' : df18_1.loc[t(30):t(38)],
-            'df18_1_up_2' : df18_1.loc[t(38):t(45.5)],
-            'df18_1_down_3' : df18_1.loc[t(45.5):],
-            'df18_2_down_0' : df18_2.loc[:t(7.8)],
-            'df18_2_up_0' : df18_2.loc[t(7.8):t(11.5)],
-            'df18_2_down_1' : df18_2.loc[t(11.5):t(24)],
-            'df18_2_up_1' : df18_2.loc[t(24):t(30)],
-            'df18_2_down_2' : df18_2.loc[t(30):t(38)],
-            'df18_2_up_2' : df18_2.loc[t(38):t(45.5)],
-            'df18_2_down_3' : df18_2.loc[t(45.5):],
-            'df18_3_down_0' : df18_3.loc[:t(7.8)],
-            'df18_3_up_0' : df18_3.loc[t(7.8):t(11.5)],
-            'df18_3_down_1' : df18_3.loc[t(11.5):t(24)],
-            'df18_3_up_1' : df18_3.loc[t(24):t(30)],
-            'df18_3_down_2' : df18_3.loc[t(30):t(38)],
-            'df18_3_up_2' : df18_3.loc[t(38):t(45.5)],
-            'df18_3_down_3' : df18_3.loc[t(45.5):],
-            'df18_4_down_0' : df18_4.loc[:t(7.8)],
-            'df18_4_up_0' : df18_4.loc[t(7.8):t(11.5)],
-            'df18_4_down_1' : df18_4.loc[t(11.5):t(24)],
-            'df18_5_down_0' : df18_5.loc[:t(7.8)],
-            'df18_5_up_0' : df18_5.loc[t(7.8):t(11.5)],
-            'df18_5_down_1' : df18_5.loc[t(11.5):t(24)],
-            'df18_6_down_0' : df18_6.loc[:t(7.8)],
-            'df18_6_up_0' : df18_6.loc[t(7.8):t(11.5)],
-            'df18_6_down_1' : df18_6.loc[t(11.5):t(24)],
-            'df18_6_up_1' : df18_6.loc[t(24):t(30)],
-            'df18_6_down_2' : df18_6.loc[t(30):t(38)],
-            'df18_6_up_2' : df18_6.loc[t(38):t(45.5)],
-            'df18_7_up_0' : df18_7.loc[t(7.8):t(11.5)],
-            'df18_7_down_1' : df18_7.loc[t(11.5):t(24)],
-            'df18_7_up_1' : df18_7.loc[t(24):t(30)],
-            'df18_8_up_0' : df18_8.loc[t(7.8):t(11.5)],
-            'df18_8_down_1' : df18_8.loc[t(11.5):t(24)],
-            'df18_8_up_1' : df18_8.loc[t(24):t(30)],
-            'df18_8_down_2' : df18_8.loc[t(30):t(38)],
-            'df18_9_up_0' : df18_9.loc[t(7.8):t(11.5)],
-            'df18_9_down_1' : df18_9.loc[t(11.5):t(24)],
-            'df18_9_up_1' : df18_9.loc[t(24):t(30)],
-            'df19_0_up_0' : df19_0.loc[t(2):t(6.8)],
-            'df19_0_down_1' : df19_0.loc[t(6.8):t(25.6)],
-            'df19_0_up_1' : df19_0.loc[t(25.6):t(34.2)],
-            'df19_0_down_2' : df19_0.loc[t(34.2):t(43)],
-            'df19_1_up_0' : df19_1.loc[t(2):t(6.8)],
-            'df19_1_down_1' : df19_1.loc[t(6.8):t(25.6)],
-            'df19_1_up_1' : df19_1.loc[t(25.6):t(34.2)],
-            'df19_1_down_2' : df19_1.loc[t(34.2):t(43)],
-            'df19_1_up_2' : df19_1.loc[t(43):t(46)],
-            'df19_1_down_3' : df19_1.loc[t(46):],
-            'df19_2_up_0' : df19_2.loc[t(2):t(6.8)],
-            'df19_2_down_1' : df19_2.loc[t(6.8):t(25.6)],
-            'df19_3_up_0' : df19_3.loc[t(2):t(6.8)],
-            'df19_3_down_1' : df19_3.loc[t(6.8):t(25.6)],
-            'df19_3_up_1' : df19_3.loc[t(25.6):t(34.2)],
-            'df19_3_down_2' : df19_3.loc[t(34.2):t(43)],
-            'df19_3_up_2' : df19_3.loc[t(43):t(46)],
-            'df19_3_down_3' : df19_3.loc[t(46):],
-            'df19_4_up_0' : df19_4.loc[t(2):t(6.8)],
-            'df19_4_down_1' : df19_4.loc[t(6.8):t(25.6)],
-            'df19_6_down_1' : df19_6.loc[t(6.8):t(25.6)],
-            'df19_6_up_1' : df19_6.loc[t(25.6):t(34.2)],
-            'df19_6_down_2' : df19_6.loc[t(34.2):t(43)],
-            'df19_6_up_2' : df19_6.loc[t(43):t(46)],
-            'df19_6_down_3' : df19_6.loc[t(46):],
-            'df19_7_down_1' : df19_7.loc[t(6.8):t(25.6)],
-            'df19_7_up_1' : df19_7.loc[t(25.6):t(34.2)],
-            'df19_7_down_2' : df19_7.loc[t(34.2):t(43)],
-            'df19_7_up_2' : df19_7.loc[t(43):t(46)],
-            'df19_7_down_3' : df19_7.loc[t(46):],
-            'df19_8_down_1' : df19_8.loc[t(6.8):t(25.6)],
-            'df19_8_up_1' : df19_8.loc[t(25.6):t(34.2)],
-            'df19_8_down_2' : df19_8.loc[t(34.2):t(43)],
-            'df19_8_up_2' : df19_8.loc[t(43):t(46)],
-            'df19_8_down_3' : df19_8.loc[t(46):],
-            'df19_9_up_1' : df19_9.loc[t(25.6):t(34.2)],
-            'df19_9_down_2' : df19_9.loc[t(34.2):t(43)],
-            'df19_9_up_2' : df19_9.loc[t(43):t(46)],
-            'df19_9_down_3' : df19_9.loc[t(46):],
-            'df19_10_up_1' : df19_10.loc[t(25.6):t(34.2)],
-            'df19_10_down_2' : df19_10.loc[t(34.2):t(43)],
-            'df19_10_up_2' : df19_10.loc[t(43):t(46)]
-        }
+# ------------------------------- Track store --------------------------------
+# A one-time columnar copy of every track*.csv under a data root: one .npy
+# file per column plus an index of (run directory, particle) row ranges.
+# Columns are memory-mapped, so tracks come back as slices of the maps.
+
+STORE_COLUMNS = ('frame', 'x', 'y', 'mass', 'particle')
+
+def find_track_files(base_addr : str) -> dict:
+    # Run directory (relative to base_addr) -> its track files, in the
+    # order load_tracks would read them.
+    found = {}
+    for subdir, dirs, files in os.walk(base_addr):
+        dirs[:] = sorted(d for d in dirs if not d.startswith('.'))
+        track_files = glob.glob(os.path.join(subdir, 'track*.csv'))
+        if track_files:
+            found[os.path.relpath(subdir, base_addr)] = track_files
+    return found
+
+@instrumented(rows=lambda args, result: 0)
+def build_track_store(base_addr : str, store_dir : str = None) -> str:
+    store_dir = store_dir or os.path.join(base_addr, '.trackstore')
+    os.makedirs(store_dir, exist_ok=True)
+
+    sources, index, columns = {}, [], {name: [] for name in STORE_COLUMNS}
+    offset = 0
+    for directory, track_files in find_track_files(base_addr).items():
+        sources.update({file: os.path.getmtime(file) for file in track_files})
+        tracks = load_tracks(os.path.join(base_addr, directory, 'track*.csv'))
+        for particle, track in enumerate(tracks):
+            index.append([directory, particle, offset, offset + len(track)])
+            offset += len(track)
+            columns['frame'].append(track.index.values)
+            for name in STORE_COLUMNS[1:]:
+                columns[name].append(track[name].values if name in track
+                                     else np.full(len(track), np.nan))
+
+    for name, parts in columns.items():
+        dtype = np.int64 if name in ('frame', 'particle') else np.float64
+        np.save(os.path.join(store_dir, name + '.npy'),
+                np.concatenate(parts).astype(dtype) if parts else np.empty(0, dtype))
+    with open(os.path.join(store_dir, 'index.json'), 'w') as f:
+        json.dump({'sources': sources, 'tracks': index}, f)
+    return store_dir
+
+class TrackStore:
+    def __init__(self, base_addr : str, store_dir : str = None):
+        self.base_addr = base_addr
+        self.store_dir = store_dir or os.path.join(base_addr, '.trackstore')
+        if self.is_stale():
+            build_track_store(base_addr, self.store_dir)
+
+        with open(os.path.join(self.store_dir, 'index.json')) as f:
+            self.index = {}
+            for directory, particle, start, stop in json.load(f)['tracks']:
+                self.index.setdefault(directory, []).append((start, stop))
+        self.columns = {name: np.load(os.path.join(self.store_dir, name + '.npy'), mmap_mode='r')
+                        for name in STORE_COLUMNS}
+
+    def is_stale(self) -> bool:
+        # Rebuild whenever a source CSV was added, removed or touched.
+        try:
+            with open(os.path.join(self.store_dir, 'index.json')) as f:
+                sources = json.load(f)['sources']
+        except (OSError, ValueError):
+            return True
+        current = {file: os.path.getmtime(file)
+                   for track_files in find_track_files(self.base_addr).values()
+                   for file in track_files}
+        return current != sources
+
+    def track(self, start : int, stop : int) -> pd.DataFrame:
+        cols = {name: self.columns[name][start:stop] for name in STORE_COLUMNS[1:]}
+        frame = pd.Index(self.columns['frame'][start:stop], name='frame')
+        return pd.DataFrame(cols, index=frame, copy=False)
+
+    def directories(self, pattern : str) -> list:
+        # Run directories matching a glob pattern, one path component at a
+        # time as glob matches them.
+        parts = os.path.normpath(pattern or '.').split(os.sep)
+        return [directory for directory in self.index
+                if len(directory.split(os.sep)) == len(parts)
+                and all(fnmatch.fnmatchcase(a, b) for a, b in zip(directory.split(os.sep), parts))]
+
+    def tracks(self, directory : str) -> list:
+        return [self.track(start, stop)
+                for start, stop in self.index.get(os.path.normpath(directory), [])]
+
+def read_manifest(manifest : str = SEGMENTS_MANIFEST) -> dict:
+    # key -> (directory, particle, start, end), with start/end in seconds
+    # and None for an open end.
+    seconds = lambda x: float(x) if x else None
+    with open(manifest, newline='') as f:
+        return {row['key']: (row['directory'], int(row['particle']),
+                             seconds(row['start']), seconds(row['end']))
+                for row in csv.DictReader(f)}
+
+class Trajectories(Mapping):
+    # Lazy view of the segment manifest. A run directory is only read and
+    # sliced the first time one of its keys is accessed, and all of that
+    # directory's segments are cached from then on.
+    def __init__(self, base_addr : str, manifest : str = SEGMENTS_MANIFEST, fps : int = 30,
+                 store : TrackStore = None, compact : bool = False):
+        # compact: hand out Track views of a TrackSet instead of DataFrames.
+        self.base_addr = base_addr
+        self.fps = fps
+        self.store = store
+        self.compact = compact
+        self.segments = read_manifest(manifest)
+        self._cache = {}
+
+    def __getitem__(self, key):
+        if key not in self._cache:
+            self._load_directory(self.segments[key][0])
+        return self._cache[key]
+
+    def __contains__(self, key):
+        return key in self.segments
+
+    def __iter__(self):
+        return iter(self.segments)
+
+    def __len__(self):
+        return len(self.segments)
+
+    @instrumented('slice_trajectories', rows=lambda args, result: 0)
+    def _load_directory(self, directory):
+        t = lambda x: None if x is None else int(round(x * self.fps))
+        tracks = load_tracks(os.path.join(self.base_addr, directory, 'track*.csv'),
+                             store=self.store)
+        if self.compact:
+            tracks = TrackSet.from_frames(tracks)
+        for key, (seg_dir, particle, start, end) in self.segments.items():
+            if seg_dir == directory:
+                self._cache[key] = (tracks[particle].between(t(start), t(end)) if self.compact
+                                    else tracks[particle].loc[t(start):t(end)])
+
+def load_all_trajectories(base_addr : str, manifest : str = SEGMENTS_MANIFEST,
+                          use_store : bool = False, compact : bool = False) -> Mapping:
+    return Trajectories(base_addr, manifest, store=TrackStore(base_addr) if use_store else None,
+                        compact=compact)
+
+def key_direction(key : str) -> str:
+    # 'up' or 'down' from the end of a manifest key ('..._<direction>_<n>',
+    # or '..._gravity' for the notebooks' field-off falls). Only the end is
+    # looked at, as the start may be a directory path with any words in it.
+    parts = key.split('_')
+    return 'up' if (parts[-2] if parts[-1].isdigit() else parts[-1]) == 'up' else 'down'
+
+def manifest_pairs(trajectories : Trajectories, min_length : int = 20) -> list:
+    # (fall key, rise key) for every segment that follows one of the other
+    # direction on the same particle, in manifest order, skipping segments
+    # of min_length rows or fewer (the Analyze notebook's pairing).
+    pairs, last = [], None
+    for key, (directory, particle, _, _) in trajectories.segments.items():
+        direction = key_direction(key)
+        if len(trajectories[key]) <= min_length:
+            last = None
+            continue
+        if last is not None and last[1] == (directory, particle) and last[2] != direction:
+            pairs.append((key, last[0]) if direction == 'down' else (last[0], key))
+        last = (key, (directory, particle), direction)
+    return pairs
+
+def write_manifest(segments : pd.DataFrame, path : str, fps : int = 30):
+    # A segment_tracks table (with a 'directory' column) in the manifest
+    # format read_manifest takes. Keys start with the whole directory path
+    # ('Trajectories/df2' -> 'Trajectories_df2_0_down_0'), so runs sharing a
+    # folder name stay apart.
+    prefix = lambda directory: '_'.join(os.path.normpath(directory).replace('\\', '/').split('/'))
+    keys = ['{}_{}_{}_{}'.format(prefix(row.directory), row.track, row.direction, row.number)
+            for row in segments.itertuples()]
+    if len(set(keys)) < len(keys):
+        raise ValueError('segment keys are not unique; rename the clashing run directories')
+    pd.DataFrame({'key': keys, 'directory': segments.directory, 'particle': segments.track,
+                  'start': segments.start_frame/fps, 'end': segments.end_frame/fps}).to_csv(
+        path, index=False)
+
+# ------------------------------ Online analysis ------------------------------
+# Charges while the capture is still running. Linked rows are fed in one
+# frame at a time; each particle's open phase is watched for a sustained
+# reversal of its trailing velocity, and every finished fall/rise pair goes
+# through analyze_df straight away. Re-estimating e is the only costly
+# step, so it is put off to a later frame whenever the current one has used
+# up its latency budget.
+
+class _LiveParticle:
+    __slots__ = ('rows', 'direction', 'flip_at', 'flips', 'last', 'last_frame')
+
+    def __init__(self):
+        self.rows = []  # (frame, x, y) of the open phase
+        self.direction = 0
+        self.flip_at = None  # row of the first step against direction
+        self.flips = 0
+        self.last = None  # previous finished (direction, Track)
+        self.last_frame = None
+
+class OnlineAnalyzer:
+    def __init__(self, px_per_mm, fps, window=15, min_speed=0.2, min_length=20,
+                 budget=None, min_charges=5, memory=0):
+        # budget: seconds per frame, one frame period by default. memory:
+        # frames a particle may go missing before its state is dropped.
+        self.px_per_mm = px_per_mm
+        self.fps = fps
+        self.window = window
+        self.min_speed = min_speed
+        self.min_length = min_length
+        self.budget = 1/fps if budget is None else budget
+        self.min_charges = min_charges
+        self.memory = memory
+        self.particles = {}
+        self.charges = []  # (particle, fall end frame, valid, charge)
+        self.e = None
+        self.overruns = 0
+        self._stale = False
+
+    def _phase_done(self, particle, state, direction, rows):
+        # Pair a finished phase with the one before it, as the Analyze
+        # notebook does, and return the new charge record if there is one.
+        track = Track(np.array(rows, dtype=np.float32), particle)
+        if len(track) <= self.min_length:
+            state.last = None
+            return None
+        previous, state.last = state.last, (direction, track)
+        if previous is None or previous[0] == direction:
+            return None
+        fall, rise = (track, previous[1]) if direction > 0 else (previous[1], track)
+        try:
+            valid, charge = analyze_df(fall, rise, self.px_per_mm, self.fps)
+        except (ValueError, ZeroDivisionError):
+            # No charge for this pair (a fall that isn't falling, say).
+            return None
+        if valid is None:
+            return None
+        record = (particle, int(fall.frame[-1]), valid, charge)
+        self.charges.append(record)
+        self._stale = True
+        return record
+
+    def _step(self, particle, frame, x, y):
+        state = self.particles.get(particle)
+        if state is None:
+            state = self.particles[particle] = _LiveParticle()
+        state.rows.append((frame, x, y))
+        state.last_frame = frame
+        if len(state.rows) <= self.window:
+            return None
+
+        # Trailing mean velocity over the window, centred window//2 rows back.
+        (f0, _, y0), (f1, _, y1) = state.rows[-1 - self.window], state.rows[-1]
+        v = (y1 - y0)/(f1 - f0)
+        sign = int(np.sign(v)) if abs(v) > self.min_speed else 0
+        if not state.direction:
+            state.direction = sign
+        elif sign == -state.direction:
+            if not state.flips:
+                state.flip_at = len(state.rows) - 1 - self.window//2
+            state.flips += 1
+            if state.flips >= self.min_length:
+                rows, state.rows = state.rows[:state.flip_at], state.rows[state.flip_at:]
+                direction, state.direction, state.flips = state.direction, sign, 0
+                return self._phase_done(particle, state, direction, rows)
+        elif sign == state.direction:
+            state.flips = 0
+        return None
+
+    def _refit(self):
+        charges = np.array([q.n for _, _, valid, q in self.charges if valid])
+        sigmas = np.array([q.s for _, _, valid, q in self.charges if valid])
+        if len(charges) >= self.min_charges:
+            self.e = estimate_e(charges, sigmas)[0]
+        self._stale = False
+
+    def update(self, rows):
+        # rows: one frame's linked features (frame, x, y, particle). Returns
+        # the charge records finished by this frame.
+        start = time.perf_counter()
+        frames, xs, ys = track_frames(rows), np.asarray(rows.x), np.asarray(rows.y)
+        new = []
+        for frame, x, y, particle in zip(frames, xs, ys, rows['particle'].values):
+            record = self._step(particle, frame, x, y)
+            if record is not None:
+                new.append(record)
+
+        if len(frames):
+            gone = [p for p, state in self.particles.items()
+                    if frames[0] - state.last_frame > self.memory + 1]
+            for particle in gone:
+                record = self._finish(particle)
+                if record is not None:
+                    new.append(record)
+
+        if self._stale:
+            if time.perf_counter() - start < self.budget:
+                self._refit()
+        if time.perf_counter() - start > self.budget:
+            self.overruns += 1
+            event('online_overrun', seconds=time.perf_counter() - start)
+        return new
+
+    def _finish(self, particle):
+        # A particle that left the field closes its open phase as it is.
+        state = self.particles.pop(particle)
+        if state.direction and state.rows:
+            return self._phase_done(particle, state, state.direction, state.rows)
+        return None
+
+    def close(self):
+        # End of the capture: close every open phase and refit.
+        new = [record for record in map(self._finish, list(self.particles))
+               if record is not None]
+        if self._stale:
+            self._refit()
+        return new
+
+    def table(self) -> pd.DataFrame:
+        return pd.DataFrame([(p, frame, valid, q.n, q.s) for p, frame, valid, q in self.charges],
+                            columns=['particle', 'frame', 'valid', 'charge', 'charge_err'])
+
+def follow_tracks(file, poll=0.1, timeout=5.0):
+    # Tails a track file that is still being written (tab-separated, with a
+    # header) and yields the rows one frame at a time. A frame is complete
+    # once a row of a later frame shows up. Stops after timeout seconds
+    # without new rows.
+    with open(file) as f:
+        header, buffer, pending, idle = None, '', [], 0.0
+        while True:
+            chunk = f.read()
+            if not chunk:
+                if idle >= timeout:
+                    break
+                time.sleep(poll)
+                idle += poll
+                continue
+            idle = 0.0
+            buffer += chunk
+            *lines, buffer = buffer.split('\n')
+            for line in lines:
+                if not line:
+                    continue
+                if header is None:
+                    header = line.split('\t')
+                    continue
+                row = dict(zip(header, line.split('\t')))
+                frame = int(float(row['frame']))
+                if pending and frame != pending[0][0]:
+                    yield _frame_rows(pending)
+                    pending = []
+                pending.append((frame, float(row['x']), float(row['y']),
+                                int(float(row['particle']))))
+        if pending:
+            yield _frame_rows(pending)
+
+def _frame_rows(rows):
+    return pd.DataFrame(rows, columns=['frame', 'x', 'y', 'particle'])
+
+def run_online(frames, analyzer):
+    # Drives an OnlineAnalyzer from per-frame rows (follow_tracks, or
+    # miltrack.live_tracks for raw frames) and yields (frame, new charge
+    # records, current e) after every frame, then once more at the end.
+    frame = None
+    for rows in frames:
+        new = analyzer.update(rows)
+        if len(rows):
+            frame = int(track_frames(rows)[0])
+        yield frame, new, analyzer.e
+    yield frame, analyzer.close(), analyzer.e
+
+
+# ------------------------------- Command line --------------------------------
+# python -m miltools {track,segment,analyze,estimate-e} ...
+# Only the track command needs the video stack (PyAV, pims, trackpy), so
+# miltrack is imported there and nowhere else.
+
+def _cmd_track(args):
+    import miltrack
+    miltrack.tp.quiet()
+    params = {name: value for name, value in
+              (('minmass', args.minmass), ('diameter', args.diameter),
+               ('walk_radius', args.walk_radius), ('memory', args.memory),
+               ('roi', tuple(args.roi) if args.roi else None),
+               ('downsample', args.downsample)) if value is not None}
+    outputs = miltrack.process_videos(args.videos, args.root, workers=args.workers,
+                                      chunk_size=args.chunk_size, cache_dir=args.cache,
+                                      videos_root=args.videos_root, **params)
+    for path in outputs.values():
+        print(path)
+
+def _cmd_segment(args):
+    tables = []
+    for directory in find_track_files(args.root):
+        tracks = load_tracks(os.path.join(args.root, directory, 'track*.csv'))
+        tables.append(segment_tracks(tracks, args.window, args.min_speed, args.min_length)
+                      .assign(directory=directory))
+    segments = (pd.concat(tables, ignore_index=True) if tables
+                else segment_tracks([]).assign(directory=[]))
+    write_manifest(segments, args.out, args.fps)
+    print('{} segments -> {}'.format(len(segments), args.out))
+
+def _cmd_analyze(args):
+    trajectories = Trajectories(args.root, args.manifest, fps=args.fps)
+    pairs = manifest_pairs(trajectories, args.min_length)
+    px_per_mm = ufloat(args.px_per_mm, args.px_per_mm_err)
+    table = analyze_pairs([(trajectories[fall], trajectories[rise]) for fall, rise in pairs],
+                          px_per_mm, args.fps, workers=args.workers)
+    table.insert(0, 'fall', [fall for fall, _ in pairs])
+    table.insert(1, 'rise', [rise for _, rise in pairs])
+    table.to_csv(args.out, index=False)
+    print('{} pairs ({} valid) -> {}'.format(len(table), (table.status == 'valid').sum(), args.out))
+
+def _cmd_estimate_e(args):
+    table = pd.read_csv(args.charges)
+    if 'status' in table:
+        table = table[table.status == 'valid']
+    sigmas = table.charge_err.values if 'charge_err' in table else None
+    e, multiples = estimate_e(table.charge.values, sigmas)
+    result = {'e': e.n, 'e_err': e.s, 'drops': len(table),
+              'multiples': np.bincount(multiples[multiples > 0]).tolist()}
+    with open(args.out, 'w') as f:
+        json.dump(result, f, indent=2)
+    print('e = {:.4e} +/- {:.1e} C from {} drops -> {}'.format(e.n, e.s, len(table), args.out))
+
+def main(argv=None):
+    import argparse
+
+    parser = argparse.ArgumentParser(prog='python -m miltools',
+                                     description='Millikan oil drop analysis.')
+    parser.add_argument('--profile', help='write a Profile report (.json or .csv)')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    track = commands.add_parser('track', help='locate and link drops in videos')
+    track.add_argument('videos', nargs='+')
+    track.add_argument('--root', required=True,
+                       help='data root; tracks go to <root>/<folder>/<video name>/track.csv')
+    track.add_argument('--videos-root',
+                       help='keep video paths under this directory instead of <folder>')
+    track.add_argument('--workers', type=int)
+    track.add_argument('--chunk-size', type=int, default=300)
+    track.add_argument('--cache', help='track cache directory')
+    track.add_argument('--minmass', type=float)
+    track.add_argument('--diameter', type=int)
+    track.add_argument('--walk-radius', type=float)
+    track.add_argument('--memory', type=int)
+    track.add_argument('--roi', type=int, nargs=4, metavar=('TOP', 'BOTTOM', 'LEFT', 'RIGHT'))
+    track.add_argument('--downsample', type=int)
+    track.set_defaults(func=_cmd_track)
+
+    segment = commands.add_parser('segment', help='split tracks into up/down segments')
+    segment.add_argument('root', help='data root holding */track*.csv')
+    segment.add_argument('--out', default='segments.csv', help='manifest to write')
+    segment.add_argument('--fps', type=int, default=30)
+    segment.add_argument('--window', type=int, default=15)
+    segment.add_argument('--min-speed', type=float, default=0.2)
+    segment.add_argument('--min-length', type=int, default=20)
+    segment.set_defaults(func=_cmd_segment)
+
+    analyze = commands.add_parser('analyze', help='charges of every fall/rise pair')
+    analyze.add_argument('root', help='data root the manifest directories are under')
+    analyze.add_argument('--manifest', default=SEGMENTS_MANIFEST)
+    analyze.add_argument('--out', default='charges.csv')
+    analyze.add_argument('--fps', type=int, default=30)
+    analyze.add_argument('--px-per-mm', type=float, default=370)
+    analyze.add_argument('--px-per-mm-err', type=float, default=20)
+    analyze.add_argument('--min-length', type=int, default=20)
+    analyze.add_argument('--workers', type=int)
+    analyze.set_defaults(func=_cmd_analyze)
+
+    estimate = commands.add_parser('estimate-e', help='elementary charge from a charge table')
+    estimate.add_argument('charges', help="analyze's output, or any CSV with a charge column")
+    estimate.add_argument('--out', default='e.json')
+    estimate.set_defaults(func=_cmd_estimate_e)
+
+    args = parser.parse_args(argv)
+    with Profile(args.profile) if args.profile else contextlib.nullcontext():
+        args.func(args)
+
+if __name__ == '__main__':
+    # Go through the importable module, so that miltrack (which imports
+    # miltools) shares its state with the command rather than this copy.
+    import miltools
+    miltools.main()
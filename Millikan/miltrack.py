@@ -0,0 +1,329 @@
+import os
+import json
+import hashlib
+import queue
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import av
+import numpy as np
+import pandas as pd
+import pims
+import trackpy as tp
+
+from miltools import instrumented, event, submit
+
+
+# ---------------------- Detection and linking parameters ---------------------
+# Calibrated in the batch_process notebook.
+
+DEFAULT_PARAMS = {'minmass': 700,
+                  'diameter': 15,
+                  'walk_radius': 11,
+                  'memory': 0,
+                  'invert': False,
+                  # Region of interest as (top, bottom, left, right) pixels, and
+                  # block-averaging factor, both applied before locating.
+                  'roi': None,
+                  'downsample': 1}
+
+
+def open_video(file):
+    return pims.as_grey(pims.PyAVReaderIndexed(file))
+
+def frame_to_grey(frame):
+    # A decoded PyAV frame, converted the way open_video's frames are, so
+    # the calibrated minmass means the same on every decode path.
+    return pims.as_grey(frame.to_ndarray(format='rgb24'))
+
+def prepare_frame(image, params):
+    # Crop to the region of interest, then block-average by the downsample
+    # factor. Drops only move inside the narrow viewing column, so this is
+    # where most of the locate time goes.
+    if params['roi'] is not None:
+        top, bottom, left, right = params['roi']
+        image = image[top:bottom, left:right]
+    k = params['downsample']
+    if k > 1:
+        h, w = image.shape[0]//k*k, image.shape[1]//k*k
+        image = image[:h, :w].reshape(h//k, k, w//k, k).mean(axis=(1, 3))
+    return image
+
+@instrumented()
+def locate_frames(frames, params, prepared=False, first_frame=0):
+    # Features in full-frame pixel coordinates. Frame numbers come from the
+    # frames' frame_no (pims) or count up from first_frame. Diameter and
+    # minmass are scaled to the downsampled image.
+    k = params['downsample']
+    diameter = max(3, int(round(params['diameter']/k)) | 1)
+    located = []
+    for i, image in enumerate(frames):
+        frame_no = getattr(image, 'frame_no', None)
+        image = image if prepared else prepare_frame(image, params)
+        features = tp.locate(image, diameter, minmass=params['minmass']/k**2,
+                             invert=params['invert'], characterize=False)
+        features['frame'] = first_frame + i if frame_no is None else frame_no
+        located.append(features)
+    if not located:
+        return pd.DataFrame(columns=['y', 'x', 'mass', 'frame'])
+
+    features = pd.concat(located, ignore_index=True)
+    top, left = (params['roi'][0], params['roi'][2]) if params['roi'] is not None else (0, 0)
+    features['y'] = (features['y'] + 0.5)*k - 0.5 + top
+    features['x'] = (features['x'] + 0.5)*k - 0.5 + left
+    return features
+
+@instrumented()
+def link_features(features, params):
+    return tp.link_df(features, params['walk_radius'], memory=params['memory'])
+
+def processFrames(frames, **params):
+    params = dict(DEFAULT_PARAMS, **params)
+    event('process_frames', frames=len(frames))
+    return link_features(locate_frames(frames, params), params)
+
+
+# ----------------------------- Streaming decode ------------------------------
+# Frames are decoded sequentially (no up-front index of the file) on a
+# prefetch thread and handed over in fixed-size chunks, already cropped and
+# downsampled. At most prefetch + 1 chunks are alive at once, so memory is
+# bounded by the chunk size rather than the video length.
+
+def video_frames(container, first_pts=None, last_pts=None):
+    # Decoded frames of the container's video stream. With first_pts and
+    # last_pts, seeks to the keyframe at or before first_pts and keeps only
+    # first_pts <= pts <= last_pts, with no index of the file needed.
+    stream = container.streams.video[0]
+    if first_pts is None:
+        yield from container.decode(stream)
+        return
+    container.seek(int(first_pts), stream=stream, backward=True)
+    for frame in container.decode(stream):
+        if frame.pts is None or frame.pts < first_pts:
+            continue
+        if frame.pts > last_pts:
+            return
+        yield frame
+
+def decode_chunks(file, params, chunk_size=100, prefetch=2, span=None):
+    # Yields (first frame number, (n, h, w) array of prepared frames). span
+    # is an optional (first frame, first pts, last pts) range of the video,
+    # as video_chunks gives them.
+    chunks = queue.Queue(maxsize=prefetch)
+    stop = threading.Event()
+    first, first_pts, last_pts = span or (0, None, None)
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                chunks.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce(first):
+        try:
+            with av.open(file) as container:
+                batch = []
+                for frame in video_frames(container, first_pts, last_pts):
+                    batch.append(prepare_frame(frame_to_grey(frame), params))
+                    if len(batch) == chunk_size:
+                        if not put((first, np.stack(batch))):
+                            return
+                        batch, first = [], first + chunk_size
+                if batch:
+                    put((first, np.stack(batch)))
+        except Exception as err:
+            put(err)
+        put(None)
+
+    thread = threading.Thread(target=produce, args=(first,), daemon=True)
+    thread.start()
+    try:
+        while True:
+            item = chunks.get()
+            if item is None:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        stop.set()
+        thread.join()
+
+def processStream(file, chunk_size=100, prefetch=2, **params):
+    # Streaming counterpart of processFrames(open_video(file)).
+    params = dict(DEFAULT_PARAMS, **params)
+    located = [locate_frames(images, params, prepared=True, first_frame=first)
+               for first, images in decode_chunks(file, params, chunk_size, prefetch)]
+    event('process_stream', file=file, chunks=len(located))
+    return link_features(pd.concat(located, ignore_index=True), params)
+
+def live_tracks(frames, first_frame=0, **params):
+    # Locates and links frames as they come in (an iterable of images, from
+    # a camera or decode_chunks) and yields each frame's linked features,
+    # for miltools.run_online. trackpy links one frame at a time here, so
+    # particle ids are settled as soon as the frame is.
+    params = dict(DEFAULT_PARAMS, **params)
+    located = (locate_frames([image], params, first_frame=first_frame + i)
+               for i, image in enumerate(frames))
+    return tp.link_df_iter(located, params['walk_radius'], memory=params['memory'])
+
+
+# ---------------------------- Batch video driver -----------------------------
+# Feature location is independent per frame, so every video is cut into
+# frame chunks that are located on a process pool. Chunk bounds come from
+# the packet timestamps, and every worker seeks straight to its own range
+# and streams it through decode_chunks, so each frame is decoded once and
+# no video is ever indexed or held whole. The chunks of a video are then
+# stitched back together and linked in one pass, so particles crossing a
+# chunk boundary keep a single id.
+
+def track_path(file, out_dir, videos_root=None):
+    # Deterministic output location, which is what load_tracks globs for:
+    # <out_dir>/<video path under videos_root>/track.csv, or without a
+    # videos_root <out_dir>/<parent folder>/<video name>/track.csv. Either
+    # way it depends on the video alone, not on what else is in the batch.
+    file = os.path.abspath(file)
+    if videos_root is None:
+        name = os.path.join(os.path.basename(os.path.dirname(file)), os.path.basename(file))
+    else:
+        name = os.path.relpath(file, os.path.abspath(videos_root))
+        if name.startswith(os.pardir):
+            raise ValueError('{} is not under {}'.format(file, videos_root))
+    return os.path.join(out_dir, os.path.splitext(name)[0], 'track.csv')
+
+def frame_times(file):
+    # Presentation timestamps of every frame, in order, from the packets
+    # alone. Unlike PyAVReaderIndexed's index nothing is decoded, so this
+    # is a quick read through the file.
+    with av.open(file) as container:
+        stream = container.streams.video[0]
+        pts = [packet.pts for packet in container.demux(stream)
+               if packet.size and packet.pts is not None]
+    return np.sort(np.array(pts, dtype=np.int64))
+
+def video_chunks(file, chunk_size):
+    # (first frame, first pts, last pts) of every chunk.
+    pts = frame_times(file)
+    return [(start, pts[start], pts[min(start + chunk_size, len(pts)) - 1])
+            for start in range(0, len(pts), chunk_size)]
+
+def _locate_chunk(file, start, first_pts, last_pts, params, batch_size=100):
+    # Runs in a worker process. Each chunk seeks to its own range and
+    # streams it through decode_chunks, so no worker indexes the whole video
+    # and at most a few batches of decoded frames are held at once.
+    located = [locate_frames(images, params, prepared=True, first_frame=first)
+               for first, images in decode_chunks(file, params, batch_size,
+                                                  span=(start, first_pts, last_pts))]
+    return pd.concat(located, ignore_index=True) if located else locate_frames([], params)
+
+def save_tracks(tracks, path):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tracks.to_csv(path, sep='\t', index=False)
+
+# ------------------------------- Track cache ---------------------------------
+# Located features are keyed by a hash of the video's contents plus the
+# locate parameters, and linked tracks additionally by the link parameters.
+# Re-linking with a new walk radius then reuses the features, and an
+# unchanged video with unchanged parameters isn't decoded at all.
+
+LOCATE_KEYS = ('minmass', 'diameter', 'invert', 'roi', 'downsample')
+LINK_KEYS = ('walk_radius', 'memory')
+
+def file_digest(file, block_size=1 << 20):
+    digest = hashlib.sha256()
+    with open(file, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+class TrackCache:
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        os.makedirs(cache_dir, exist_ok=True)
+
+        # Digests are remembered per (size, mtime), so unchanged videos
+        # aren't re-read just to be hashed.
+        self._digest_file = os.path.join(cache_dir, 'digests.json')
+        try:
+            with open(self._digest_file) as f:
+                self._digests = json.load(f)
+        except (OSError, ValueError):
+            self._digests = {}
+
+    def digest(self, file):
+        stat = os.stat(file)
+        path = os.path.abspath(file)
+        size, mtime, digest = self._digests.get(path, (None, None, None))
+        if (size, mtime) != (stat.st_size, stat.st_mtime):
+            digest = file_digest(file)
+            self._digests[path] = (stat.st_size, stat.st_mtime, digest)
+            with open(self._digest_file, 'w') as f:
+                json.dump(self._digests, f)
+        return digest
+
+    def _path(self, kind, file, params, keys):
+        key = json.dumps([self.digest(file)] + [params[k] for k in keys])
+        name = hashlib.sha256(key.encode()).hexdigest()[:32]
+        return os.path.join(self.cache_dir, kind, name + '.pkl')
+
+    def features_path(self, file, params):
+        return self._path('features', file, params, LOCATE_KEYS)
+
+    def tracks_path(self, file, params):
+        return self._path('tracks', file, params, LOCATE_KEYS + LINK_KEYS)
+
+    def load(self, path):
+        return pd.read_pickle(path) if os.path.exists(path) else None
+
+    def save(self, df, path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        df.to_pickle(path)
+
+
+@instrumented(rows=lambda args, result: len(result))
+def process_videos(files, out_dir, workers=None, chunk_size=300, cache_dir=None,
+                   videos_root=None, **params) -> dict:
+    params = dict(DEFAULT_PARAMS, **params)
+    cache = TrackCache(cache_dir) if cache_dir else None
+    outputs = {file: track_path(file, out_dir, videos_root) for file in files}
+
+    def finish(file, features):
+        tracks = link_features(features, params)
+        if cache:
+            cache.save(tracks, cache.tracks_path(file, params))
+        save_tracks(tracks, outputs[file])
+
+    to_locate = []
+    for file in files:
+        if cache is None:
+            to_locate.append(file)
+        elif os.path.exists(cache.tracks_path(file, params)):
+            # Always rewritten: the file on disk may be from other parameters.
+            save_tracks(cache.load(cache.tracks_path(file, params)), outputs[file])
+        elif os.path.exists(cache.features_path(file, params)):
+            finish(file, cache.load(cache.features_path(file, params)))
+        else:
+            to_locate.append(file)
+
+    if not to_locate:
+        return outputs
+
+    # Spawned rather than forked workers: PyAV's decoder state doesn't
+    # survive a fork of a parent that has already opened a video.
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context) as pool:
+        futures = {file: [submit(pool, _locate_chunk, file, *chunk, params)
+                          for chunk in video_chunks(file, chunk_size)]
+                   for file in to_locate}
+
+        for file, chunk_futures in futures.items():
+            features = pd.concat([future.result() for future in chunk_futures],
+                                 ignore_index=True)
+            if cache:
+                cache.save(features, cache.features_path(file, params))
+            finish(file, features)
+    return outputs